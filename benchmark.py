@@ -0,0 +1,298 @@
+# Python source file: benchmark.py
+
+# Benchmarks for the build and query pipeline.
+# A synthetic corpus of a given scale is generated (words drawn from a
+# made-up vocabulary with Zipfian frequencies, plus the ordinals used by
+# search_queries), and each stage is run on it in turn:
+#    entries : generateAllIndexEntries
+#    split   : splitIntoSortedChunks
+#    merge   : mergeFilesInRange
+#    index   : createIndexFromEntries
+#    meta    : generateMetaIndex
+#    hasher  : perfect_hashing.Hasher for all keys
+#    queryQ  : allHits with HitStreamQ for a fixed set of queries
+#    queryG  : the same with HitStreamG
+# The stages are run Repeats times timed, and once more under tracemalloc
+# for their peak memory (tracing slows Python down, so the two are kept
+# apart). The time of a single run varies by a fifth or more with the
+# load of the machine and garbage collection, so one run cannot tell a
+# regression from noise: the median of the runs is kept instead (the
+# collector being off while timing, as for timeit).
+# Results go to a JSON file, and may be compared with a stored baseline,
+# stages slower (or larger) than the baseline by more than a tolerance
+# being reported as regressions.
+
+# Usage:
+#    python benchmark.py --scale 2                     # run and compare
+#    python benchmark.py --scale 2 --save-baseline     # run and store
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import statistics
+import tempfile
+import tracemalloc
+
+import buffered_io
+import index_build
+import perfect_hashing
+import search_queries
+
+WordsPerScale = 100000
+# :corpus words at scale 1
+
+VocabularySize = 20000
+
+DocCodes = ['SYA', 'SYB', 'SYC']
+# :the corpus is spread over these documents
+
+Ordinals = ['first', 'second', 'third', 'fourth', 'fifth', 'sixth',
+            'seventh', 'eighth', 'ninth', 'tenth', 'eleventh', 'twelfth']
+# :as in search_queries.ordinals, so that its fixed query can be run
+
+QueryRounds = 10
+# :the query set is run this many times, queries being quick
+
+Repeats = 5
+# :timed runs of the stages
+
+
+# Synthetic corpora:
+
+def syntheticVocabulary(rng, size):
+    vocabulary = set(Ordinals)
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                               for i in range(rng.randint(4, 10))))
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)  # :ranks by frequency are random
+    return vocabulary
+
+
+def syntheticCorpus(directory, scale, seed=1):
+    # writes the corpus files into directory,
+    # returning (CorpusFiles, vocabulary in order of frequency)
+    rng = random.Random(seed)
+    vocabulary = syntheticVocabulary(rng, VocabularySize)
+    weights = [1 / (r + 1) for r in range(len(vocabulary))]
+    words = rng.choices(vocabulary, weights, k=int(WordsPerScale * scale))
+    corpusFiles = {}
+    perDoc = len(words) // len(DocCodes) + 1
+    for d in range(len(DocCodes)):
+        filename = os.path.join(directory, DocCodes[d] + '.txt')
+        writer = open(filename, 'w', encoding='utf-8')
+        docWords = words[d * perDoc:(d + 1) * perDoc]
+        i = 0
+        while i < len(docWords):
+            n = rng.randint(6, 12)
+            line = ' '.join(docWords[i:i + n])
+            writer.write(line[0].upper() + line[1:] + '.\n')
+            i += n
+        writer.close()
+        corpusFiles[DocCodes[d]] = filename
+    return (corpusFiles, vocabulary)
+
+
+def fixedQueries(vocabulary):
+    # :the ordinals, and pairs of words of various frequencies
+    queries = [Ordinals]
+    for r in [0, 10, 100, 1000]:
+        for i in range(5):
+            queries.append([vocabulary[r + i], vocabulary[r + 500 + i]])
+    return queries
+
+
+def queryHits(HS, queries):
+    # :number of hits of all queries, with hit stream class HS
+    hits = 0
+    for keys in queries * QueryRounds:
+        itemStreams = [s for s in search_queries.itemStreamsFor(keys)
+                       if s is not None]
+        if len(itemStreams) >= 2:
+            hits += len(search_queries.allHits(HS(itemStreams, 1)))
+    return hits
+
+
+# Running the stages:
+
+def runStage(results, name, traced, work, amount, unit):
+    # runs work(), recording its time (or its peak memory, if traced)
+    # in results[name]; seconds and throughput are those of the median
+    # of the runs so far; returns what work returns
+    record = results.setdefault(name, {'unit': unit, 'runs': []})
+    if traced:
+        tracemalloc.start()
+        value = work()
+        record['peakBytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        gc.collect()
+        gc.disable()
+        try:
+            time_start = time.perf_counter()
+            value = work()
+            seconds = time.perf_counter() - time_start
+        finally:
+            gc.enable()
+        record['runs'].append(seconds)
+        record['seconds'] = seconds = statistics.median(record['runs'])
+        n = amount(value) if callable(amount) else amount
+        record['throughput'] = n / seconds if seconds > 0 else None
+    return value
+
+
+def runStages(results, queries, traced):
+    ib = index_build
+    stage = (lambda name, work, amount, unit:
+             runStage(results, name, traced, work, amount, unit))
+    entries = stage('entries', lambda: ib.generateAllIndexEntries('raw_entries'),
+                    lambda n: n, 'entries/s')
+    chunks = stage('split', lambda: ib.splitIntoSortedChunks('raw_entries'),
+                   entries, 'entries/s')
+    os.remove('raw_entries')
+    sortedFile = stage('merge', lambda: ib.mergeFilesInRange(0, chunks),
+                       entries, 'entries/s')
+    stage('index', lambda: ib.createIndexFromEntries(sortedFile, 'index.txt'),
+          entries, 'entries/s')
+    os.remove(sortedFile)
+    stage('meta', lambda: ib.generateMetaIndex('index.txt', 'index.meta'),
+          lambda v: len(ib.MetaIndex), 'keys/s')
+    keys = list(ib.MetaIndex.keys())
+    stage('hasher', lambda: perfect_hashing.Hasher(keys, 5.0, 0.8),
+          len(keys), 'keys/s')
+    ib.loadMetaIndex('index.txt', 'index.meta')  # :reads index lines directly
+    for (name, HS) in [('queryQ', search_queries.HitStreamQ),
+                       ('queryG', search_queries.HitStreamG)]:
+        stage(name, lambda: queryHits(HS, queries), lambda hits: hits, 'hits/s')
+
+
+def runBenchmark(scale=1.0, seed=1, repeats=None):
+    # runs all stages on a synthetic corpus, in a temporary directory,
+    # timing them repeats times; returns the results as a dictionary
+    global Repeats
+    if repeats is None:
+        repeats = Repeats
+    ib = index_build
+    saved = (os.getcwd(), ib.CorpusFiles, ib.IndexFile, ib.MetaIndexFile,
+             ib.MetaIndex, ib.MetaIndexOp, ib.MetaIndexExact)
+    # :a mapped MetaIndex is closed by the build, and reloaded afterwards
+    directory = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        corpusFiles, vocabulary = syntheticCorpus(directory, scale, seed)
+        os.chdir(directory)
+        ib.CorpusFiles, ib.IndexFile = corpusFiles, 'index.txt'
+        ib.MetaIndexFile = 'index.meta'
+        queries = fixedQueries(vocabulary)
+        stages = {}
+        for r in range(repeats):
+            runStages(stages, queries, False)
+        runStages(stages, queries, True)
+    finally:
+        if not isinstance(ib.MetaIndex, dict):
+            ib.MetaIndex.close()
+        os.chdir(saved[0])
+        (ib.CorpusFiles, ib.IndexFile, ib.MetaIndexFile, ib.MetaIndex,
+         ib.MetaIndexOp, ib.MetaIndexExact) = saved[1:]
+        ib.SortedKeysCache = None
+        if isinstance(ib.MetaIndex, ib.MappedMetaIndex):
+            ib.loadMetaIndex(ib.IndexFile, ib.MetaIndexFile)
+        elif isinstance(ib.MetaIndex, ib.TermDictionary):
+            ib.MetaIndex = {}
+            ib.loadTermDictionary(ib.IndexFile)
+        shutil.rmtree(directory)
+    return {'scale': scale, 'seed': seed, 'repeats': repeats,
+            'words': int(WordsPerScale * scale),
+            'memoryAllowance': buffered_io.MemoryAllowance,
+            'python': sys.version.split()[0],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'stages': stages}
+
+
+# Comparing with a baseline:
+
+def compareResults(results, baseline, tolerance=0.2):
+    # prints each stage against the baseline, returning the names of
+    # stages slower or larger by more than the tolerance (a fraction)
+    regressions = []
+    if baseline.get('scale') != results['scale']:
+        print('Warning: baseline scale ' + str(baseline.get('scale')) +
+              ' differs from ' + str(results['scale']))
+    print('stage'.ljust(10) + 'seconds'.rjust(10) + 'baseline'.rjust(10) +
+          'change'.rjust(9) + 'peak KB'.rjust(10) + 'baseline'.rjust(10) +
+          'change'.rjust(9))
+    for name in results['stages']:
+        curr = results['stages'][name]
+        base = baseline['stages'].get(name, {})
+        line = name.ljust(10)
+        regressed = False
+        for field, scale in [('seconds', 1), ('peakBytes', 1024)]:
+            value = curr.get(field)
+            old = base.get(field)
+            line += format(value / scale, '10.3f') if value is not None \
+                else ' ' * 10
+            if old:
+                change = value / old - 1
+                line += format(old / scale, '10.3f') + \
+                    format(change * 100, '+8.1f') + '%'
+                regressed = regressed or change > tolerance
+            else:
+                line += ' ' * 19
+        if regressed:
+            line += '  REGRESSION'
+            regressions.append(name)
+        print(line)
+    return regressions
+
+
+def saveResults(results, filename):
+    writer = open(filename, 'w', encoding='utf-8')
+    json.dump(results, writer, indent=2)
+    writer.write('\n')
+    writer.close()
+
+
+def loadResults(filename):
+    reader = open(filename, encoding='utf-8')
+    results = json.load(reader)
+    reader.close()
+    return results
+
+
+def main(argv=None):
+    # :command line interface (argv as for argparse; see Usage above)
+    import argparse
+    parser = argparse.ArgumentParser(prog='benchmark')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='corpus size, in units of ' +
+                        str(WordsPerScale) + ' words')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=Repeats,
+                        help='timed runs (the median being compared)')
+    parser.add_argument('--results', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown (fraction) reported as a regression')
+    args = parser.parse_args(argv)
+    results = runBenchmark(args.scale, args.seed, args.repeats)
+    saveResults(results, args.results)
+    if args.save_baseline:
+        saveResults(results, args.baseline)
+        print('Baseline saved to ' + args.baseline)
+    elif os.path.exists(args.baseline):
+        regressions = compareResults(results, loadResults(args.baseline),
+                                     args.tolerance)
+        return 1 if regressions != [] else 0
+    else:
+        compareResults(results, {'stages': {}})
+    return 0
+
+
+# End of file
+if __name__ == '__main__':
+    sys.exit(main())
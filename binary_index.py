@@ -0,0 +1,297 @@
+# Python source file: binary_index.py
+
+# A compact binary alternative to the text index file.
+# For each key, postings are stored as groups, one per document:
+#    docId, count, byteLength, line, delta, delta, ...
+# all as varints (7 bits per byte, high bit set on all but the last byte),
+# with line numbers delta-encoded within a group. The byteLength lets a
+# reader skip a whole document group without decoding it.
+# Keys are kept sorted in a separate table with their posting offsets,
+# so that a lookup is a binary search touching only a few pages of the
+# memory-mapped file.
+
+# File layout:
+#    header   : magic, numDocs, numKeys and offsets of the sections below
+#    postings : groups for key 0, key 1, ...
+#    docs     : three-letter document codes, docId i at bytes 3i..3i+3
+#    keys     : UTF-8 keys concatenated
+#    keyStart : numKeys+1 uint64 offsets into keys
+#    postStart: numKeys+1 uint64 offsets into the file (start of postings)
+
+import os
+import mmap
+import struct
+from array import array
+
+import buffered_io
+from buffered_io import BufferedInput
+from meta_index import tempFileFor
+
+Magic = b'IXBIN001'
+Header = struct.Struct('<8sQQQQQQ')
+# :magic, numDocs, numKeys, docsOffset, keysOffset,
+# :keyStartOffset, postStartOffset
+
+
+def encodeVarint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decodeVarint(buf, pos):
+    # :returns (value, position after it)
+    b = buf[pos]
+    n = b & 0x7f
+    shift = 7
+    while b & 0x80:
+        pos += 1
+        b = buf[pos]
+        n |= (b & 0x7f) << shift
+        shift += 7
+    return (n, pos + 1)
+
+
+PieceSize = 4096
+# :postings of an index line are split a piece of about this many
+# :characters at a time, so that the line of a frequent key (tens of
+# :kilobytes) is never split into a list of all its postings at once
+
+
+def indexLineGroups(inl):
+    # 'key:ABC01,23,DEF004,056\n'
+    #     -> ('ABC', 2, deltas of 1, 23), ('DEF', 2, deltas of 4, 56)
+    # generator of (doc, count, line numbers delta-encoded) for the
+    # documents in an index line
+    global PieceSize
+    doc, count, prev, deltas = None, 0, 0, bytearray()
+    pos = inl.index(':') + 1
+    stop = len(inl) - 1 if inl.endswith('\n') else len(inl)
+    while pos < stop:
+        cut = inl.find(',', min(pos + PieceSize, stop), stop)
+        if cut == -1:
+            cut = stop
+        for ref in inl[pos:cut].split(','):
+            if ref[0].isalpha():
+                if doc is not None:
+                    yield (doc, count, deltas)
+                doc, count, prev, deltas = ref[:3], 0, 0, bytearray()
+                line = int(ref[3:])
+            else:
+                line = int(ref)
+            encodeVarint(line - prev, deltas)
+            prev = line
+            count += 1
+        pos = cut + 1
+    if doc is not None:
+        yield (doc, count, deltas)
+
+
+def encodeGroup(docId, count, deltas, out):
+    encodeVarint(docId, out)
+    encodeVarint(count, out)
+    encodeVarint(len(deltas), out)
+    out += deltas
+
+
+def createBinaryIndex(indexFile, binFile, shares=(0.4, 0.3)):
+    # converts a text index file (as written by createIndexFromEntries)
+    # into the binary format, in one streaming pass; shares are the
+    # memoryShares of the reader and of the buffer of postings written
+    reader = BufferedInput(indexFile, shares[0])
+    tempFile = tempFileFor(binFile)
+    writer = open(tempFile, 'wb')
+    maxSize = int(buffered_io.MemoryAllowance * shares[1])
+    writer.write(bytes(Header.size))  # :header filled in at the end
+    pos = Header.size
+    docIds, docs = {}, []
+    keys = bytearray()
+    keyStart, postStart = array('Q', [0]), array('Q', [pos])
+    buffer = bytearray()
+    inl = reader.readln()
+    while inl is not None:
+        for (doc, count, deltas) in indexLineGroups(inl):
+            if doc not in docIds:
+                docIds[doc] = len(docs)
+                docs.append(doc)
+            encodeGroup(docIds[doc], count, deltas, buffer)
+        keys += inl[:inl.index(':')].encode('utf-8')
+        keyStart.append(len(keys))
+        postStart.append(pos + len(buffer))
+        if len(buffer) > maxSize:
+            writer.write(buffer)
+            pos += len(buffer)
+            buffer = bytearray()
+        inl = reader.readln()
+    reader.close()
+    docsOffset = pos + len(buffer)
+    buffer += ''.join(docs).encode('ascii')
+    keysOffset = docsOffset + 3 * len(docs)
+    buffer += keys
+    padding = -(keysOffset + len(keys)) % 8  # :align the offset arrays
+    buffer += bytes(padding)
+    keyStartOffset = keysOffset + len(keys) + padding
+    postStartOffset = keyStartOffset + 8 * len(keyStart)
+    writer.write(buffer)
+    writer.write(keyStart.tobytes())
+    writer.write(postStart.tobytes())
+    writer.seek(0)
+    writer.write(Header.pack(Magic, len(docs), len(keyStart) - 1, docsOffset,
+                             keysOffset, keyStartOffset, postStartOffset))
+    writer.close()
+    os.replace(tempFile, binFile)
+    return len(keyStart) - 1
+
+
+# Reading the binary index through mmap:
+
+class BinaryIndex:
+    def __init__(self, binFile):
+        self.reader = open(binFile, 'rb')
+        self.mm = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, numDocs, self.numKeys, docsOffset, self.keysOffset,
+         keyStartOffset, postStartOffset) = Header.unpack_from(self.mm, 0)
+        if magic != Magic:
+            raise Exception('Not a binary index file: ' + binFile)
+        self.docs = [self.mm[docsOffset + 3 * i:docsOffset + 3 * i + 3]
+                     .decode('ascii') for i in range(numDocs)]
+        self.view = memoryview(self.mm)
+        n = 8 * (self.numKeys + 1)
+        self.keyStart = self.view[keyStartOffset:
+                                  keyStartOffset + n].cast('Q')
+        self.postStart = self.view[postStartOffset:
+                                   postStartOffset + n].cast('Q')
+
+    def key(self, i):
+        start = self.keysOffset + self.keyStart[i]
+        end = self.keysOffset + self.keyStart[i + 1]
+        return self.mm[start:end].decode('utf-8')
+
+    def find(self, key):
+        # :binary search for key, returning its number or None
+        b = key.encode('utf-8')
+        lo, hi = 0, self.numKeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.keysOffset + self.keyStart[mid]
+            k = self.mm[start:self.keysOffset + self.keyStart[mid + 1]]
+            if k < b:
+                lo = mid + 1
+            elif k > b:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def itemStream(self, key):
+        i = self.find(key)
+        if i is None:
+            return None
+        return BinaryItemStream(self.mm, self.postStart[i],
+                                self.postStart[i + 1], self.docs)
+
+    def decodedPostings(self, key):
+        # (docs, lines) for key, where lines[i] is an array of the
+        # line numbers in document docs[i]; None if key is absent
+        i = self.find(key)
+        if i is None:
+            return None
+        docs, lines = [], []
+        pos, end = self.postStart[i], self.postStart[i + 1]
+        while pos < end:
+            docId, pos = decodeVarint(self.mm, pos)
+            count, pos = decodeVarint(self.mm, pos)
+            size, pos = decodeVarint(self.mm, pos)
+            group = array('I')
+            line = 0
+            for j in range(count):
+                delta, pos = decodeVarint(self.mm, pos)
+                line += delta
+                group.append(line)
+            docs.append(self.docs[docId])
+            lines.append(group)
+        return (docs, lines)
+
+    def close(self):
+        self.keyStart.release()
+        self.postStart.release()
+        self.view.release()
+        self.mm.close()
+        self.reader.close()
+
+
+# Item streams over binary postings, with the same interface as
+# search_queries.ItemStream, so that they can be fed to HitStreamQ:
+
+class BinaryItemStream:
+    def __init__(self, buf, start, end, docs):
+        self.buf = buf
+        self.pos = start
+        self.end = end
+        self.docs = docs
+        self.doc = None
+        self.left = 0   # :items left in current document group
+        self.line = 0
+        self.groupEnd = start  # :where the next document group begins
+        self.item = self.decode()
+
+    def decodeHeader(self, pos):
+        # :(doc, count, position of first delta, end of group) for group at pos
+        docId, pos = decodeVarint(self.buf, pos)
+        count, pos = decodeVarint(self.buf, pos)
+        size, pos = decodeVarint(self.buf, pos)
+        return (self.docs[docId], count, pos, pos + size)
+
+    def decode(self):
+        if self.left == 0:
+            if self.groupEnd >= self.end:
+                return None
+            self.doc, self.left, self.pos, self.groupEnd = \
+                self.decodeHeader(self.groupEnd)
+            self.line = 0
+        delta, self.pos = decodeVarint(self.buf, self.pos)
+        self.line += delta
+        self.left -= 1
+        return (self.doc, self.line)
+
+    def peek(self):
+        return self.item
+
+    def pop(self):
+        e = self.item
+        if e is not None:
+            self.item = self.decode()
+        return e
+
+    def size(self):
+        # :estimate, in bytes still to be decoded
+        return self.end - self.pos
+
+    def skipToLast(self, bound, inclusive):
+        # moves on so that the next item is the last one before bound
+        # (or equal to it, if inclusive), skipping whole document groups
+        # where possible; stays put if the next item is not before bound
+        if self.item is None or not (self.item < bound or
+                                     (inclusive and self.item == bound)):
+            return
+        while self.groupEnd < self.end:
+            doc, count, pos, groupEnd = self.decodeHeader(self.groupEnd)
+            first, pos = decodeVarint(self.buf, pos)
+            if not ((doc, first) < bound or
+                    (inclusive and (doc, first) == bound)):
+                break
+            self.doc, self.left, self.pos, self.groupEnd = \
+                doc, count - 1, pos, groupEnd
+            self.line = first
+            self.item = (doc, first)
+        while self.left > 0:
+            delta, pos = decodeVarint(self.buf, self.pos)
+            e = (self.doc, self.line + delta)
+            if not (e < bound or (inclusive and e == bound)):
+                break
+            self.pos, self.line, self.left = pos, self.line + delta, self.left - 1
+            self.item = e
+
+
+# End of file
@@ -9,15 +9,23 @@
 MemoryAllowance = 1000000  # bytes
 # :goal is to see how to process 'large' files using 'small' working memory
 
+from pipeline_stats import Stats
+# :counts lines read and text written, if enabled
+
 class BufferedInput:
     def __init__(self,filename,memoryShare):
         global MemoryAllowance
         self.reader = open(filename,'r',encoding='utf-8')
         self.maxSize = int(MemoryAllowance * memoryShare)
+        self.fill()
+        self.pos = 0
+    def fill(self):
+        self.buffer = []  # :lets the old lines go before reading new ones
         self.buffer = self.reader.readlines(self.maxSize-100)
                       # :to allow for lines of length <= 100
                       # :(adequate for index entry files)
-        self.pos = 0
+        if Stats.enabled:
+            Stats.add('linesRead',len(self.buffer))
     def readln(self): # :returns next line of file
                       # :once end of file reached, returns None forever
         if self.buffer == []:
@@ -26,12 +34,12 @@ class BufferedInput:
             result = self.buffer[self.pos]
             self.pos += 1
             if self.pos == len(self.buffer):
-                self.buffer = self.reader.readlines(self.maxSize-100)
+                self.fill()
                 self.pos = 0
             return result
     def readchunk(self): # :returns entire buffer contents
         currBuffer = self.buffer
-        self.buffer = self.reader.readlines(self.maxSize-100)
+        self.fill()
         self.pos = 0
         return currBuffer
     def close(self):
@@ -51,6 +59,8 @@ class BufferedOutput:
         newSize = self.currSize + len(str) + 4
                   # :allow overhead of 4 bytes per string (estimate)
         if newSize > self.maxSize:
+            if Stats.enabled:
+                Stats.add('bytesWritten',self.currSize - 4*self.pos)
             self.writer.writelines(self.buffer[:self.pos])
             newSize = len(str) + 4
             self.pos = 0
@@ -58,7 +68,80 @@ class BufferedOutput:
         self.pos += 1
         self.currSize = newSize
     def flush(self): # :flushes buffer and closes file
+        if Stats.enabled:
+            Stats.add('bytesWritten',self.currSize - 4*self.pos)
         self.writer.writelines(self.buffer[:self.pos])
         self.writer.close()
 
+# Bytes-level versions of the above, for files of ASCII/UTF-8 lines ending
+# in \n (such as index entry files): input lines are bytes slices of a
+# memory-mapped file, with no decoding, and output is gathered in a
+# bytearray, so that its size in bytes is known exactly.
+
+import mmap
+
+class MappedInput:
+    def __init__(self,filename,memoryShare):
+        global MemoryAllowance
+        self.reader = open(filename,'rb')
+        self.maxSize = int(MemoryAllowance * memoryShare)
+        self.size = self.reader.seek(0,2)
+        if self.size > 0:
+            self.mm = mmap.mmap(self.reader.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            self.mm = None  # :empty files can't be mapped
+        self.pos = 0
+    def readln(self): # :returns next line of file (as bytes)
+                      # :once end of file reached, returns None forever
+        if self.pos >= self.size:
+            return None
+        end = self.mm.find(b'\n',self.pos)
+        end = self.size if end == -1 else end + 1
+        result = self.mm[self.pos:end]
+        self.pos = end
+        return result
+    def readchunk(self): # :returns list of lines making up about maxSize bytes
+        if self.pos >= self.size:
+            return []
+        end = self.mm.find(b'\n',max(self.pos,min(self.pos + self.maxSize,self.size) - 1))
+        end = self.size if end == -1 else end + 1
+        chunk = self.mm[self.pos:end].splitlines(keepends=True)
+        self.pos = end
+        return chunk
+    def close(self):
+        if self.mm is not None:
+            if Stats.enabled:
+                Stats.add('linesRead',self.linesRead())
+            self.mm.close()
+        self.reader.close()
+    def linesRead(self): # :number of lines before pos (counted on close,
+                         # :so that reading costs nothing extra)
+        step = 1 << 20
+        lines = sum(self.mm[i:min(i + step,self.pos)].count(b'\n')
+                    for i in range(0,self.pos,step))
+        if self.pos > 0 and self.mm[self.pos - 1] != 10:
+            lines += 1  # :last line has no line break
+        return lines
+
+class BytesOutput:
+    def __init__(self,filename,memoryShare):
+        global MemoryAllowance
+        self.writer = open(filename,'wb')
+        self.maxSize = int(MemoryAllowance * memoryShare)
+        self.buffer = bytearray()
+    def writeln(self,line): # :line may be bytes, or str to be encoded
+        if line.__class__ is str:
+            line = line.encode('utf-8')
+        self.buffer += line
+        if len(self.buffer) > self.maxSize:
+            if Stats.enabled:
+                Stats.add('bytesWritten',len(self.buffer))
+            self.writer.write(self.buffer)
+            self.buffer.clear()
+    def flush(self): # :flushes buffer and closes file
+        if Stats.enabled:
+            Stats.add('bytesWritten',len(self.buffer))
+        self.writer.write(self.buffer)
+        self.writer.close()
+
 # End of file
@@ -0,0 +1,140 @@
+# Python source file: cli.py
+
+# Command line entry point for building the index, querying it and
+# running the benchmarks. The library modules do nothing on import (the
+# meta-index is loaded on the first lookup), and each command imports
+# only the modules it needs, so that queries start without a build.
+
+# Usage:
+#    python cli.py build [--backend bytes] [--binary] [--workers 4] ...
+#    python cli.py build --shards 4 [--scheme hash]
+#    python cli.py query first second [--window 3] [--hits 20] [--ranked]
+#    python cli.py query first second --sharded
+#    python cli.py benchmark [--scale 2] [--save-baseline] ...
+#      (options as for benchmark.py)
+
+import sys
+import time
+import argparse
+
+
+def setMemoryAllowance(allowance):
+    import buffered_io
+    import index_build
+    buffered_io.MemoryAllowance = allowance
+    index_build.MemoryAllowance = allowance  # :copy made by import *
+
+
+def buildCommand(args):
+    import index_build
+    from memory_budget import MemoryBudget
+    from pipeline_stats import Stats
+    if args.memory is not None:
+        setMemoryAllowance(args.memory)
+    index_build.IOBackend = args.backend
+    index_build.StreamBuild = not args.no_stream
+    index_build.RecordBuild = args.records
+    index_build.EntryWorkers = args.workers
+    if args.binary:
+        index_build.IndexFormat = 'binary'
+    if args.enforce or args.trace:
+        index_build.Budget = MemoryBudget(args.enforce, args.trace)
+    Stats.enabled = args.stats or args.profile
+    Stats.profile = args.profile
+    time_start = time.time()
+    if args.shards is not None:
+        import sharded_index
+        sharded_index.buildShardedIndex(args.shards, args.scheme,
+                                        args.shard_workers)
+        print('totally cost', time.time() - time_start)
+        return 0
+    index_build.buildIndex()
+    if args.terms:
+        import term_dictionary
+        term_dictionary.writeTermDictionary(index_build.TermDictFile,
+                                            index_build.IndexFile)
+    print('totally cost', time.time() - time_start)
+    return 0
+
+
+def queryCommand(args):
+    import index_build
+    import search_queries
+    if args.sharded:
+        search_queries.useShardedIndex()
+    if args.binary:
+        index_build.IndexFormat = 'binary'
+    if args.terms:
+        index_build.loadTermDictionary(index_build.IndexFile)
+    if args.perfect:
+        import perfect_hashing
+        perfect_hashing.installPerfectMetaIndex()
+    search_queries.search(args.keys, args.window, args.hits, args.ranked,
+                          args.min)
+    return 0
+
+
+def benchmarkCommand(argv):
+    import benchmark
+    return benchmark.main(argv)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    b = commands.add_parser('build', help='build the index of CorpusFiles')
+    b.add_argument('--memory', type=int, default=None,
+                   help='MemoryAllowance in bytes')
+    b.add_argument('--backend', choices=['text', 'bytes'], default='text')
+    b.add_argument('--no-stream', action='store_true',
+                   help='write raw entries to a file before sorting')
+    b.add_argument('--records', action='store_true',
+                   help='sort packed records (needs NumPy)')
+    b.add_argument('--workers', type=int, default=1)
+    b.add_argument('--binary', action='store_true',
+                   help='also write the binary index')
+    b.add_argument('--terms', action='store_true',
+                   help='also write the term dictionary')
+    b.add_argument('--enforce', action='store_true',
+                   help='keep real buffer memory within the allowance')
+    b.add_argument('--trace', action='store_true',
+                   help='report traced peak memory per stage')
+    b.add_argument('--stats', action='store_true',
+                   help='report counters and stage times')
+    b.add_argument('--profile', action='store_true',
+                   help='also profile each stage')
+    b.add_argument('--shards', type=int, default=None,
+                   help='build this many shards (see sharded_index.py)')
+    b.add_argument('--scheme', choices=['range', 'hash'], default='range')
+    b.add_argument('--shard-workers', type=int, default=None,
+                   help='processes building shards (default one each)')
+    q = commands.add_parser('query', help='search the index')
+    q.add_argument('keys', nargs='+')
+    q.add_argument('--window', type=int, default=1)
+    q.add_argument('--hits', type=int, default=5)
+    q.add_argument('--ranked', action='store_true')
+    q.add_argument('--min', type=int, default=2,
+                   help='terms required in a hit')
+    q.add_argument('--binary', action='store_true',
+                   help='read postings from the binary index')
+    q.add_argument('--terms', action='store_true',
+                   help='use the term dictionary as meta-index')
+    q.add_argument('--perfect', action='store_true',
+                   help='look keys up by perfect hashing')
+    q.add_argument('--sharded', action='store_true',
+                   help='query the sharded index')
+    commands.add_parser('benchmark', add_help=False,
+                        help='run benchmark.py (same options)')
+    args, rest = parser.parse_known_args(argv)
+    if args.command == 'benchmark':
+        return benchmarkCommand(rest)
+    if rest != []:
+        parser.error('unrecognized arguments: ' + ' '.join(rest))
+    if args.command == 'build':
+        return buildCommand(args)
+    return queryCommand(args)
+
+
+# End of file
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# Python source file: corpus_lines.py
+
+# Random access to lines of the corpus files, for displaying hits.
+# linecache reads a whole book into a list of lines on first use; here
+# each corpus file is memory-mapped instead, and a persisted line index
+# (the byte offset of every line) lets us read just the lines shown.
+# Line breaks are \n, \r\n and \r, as for files read in text mode, so that
+# line numbers agree with those in the index.
+# Recently shown line ranges are kept in a small LRU cache, so that
+# redisplaying them (e.g. by several queries) reads nothing at all.
+
+# Line index file layout:
+#    header  : magic, size and mtime of the corpus file, numLines
+#    offsets : numLines+1 uint64 byte offsets (the last is the file size)
+
+import os
+import re
+import mmap
+import struct
+from array import array
+from collections import OrderedDict
+
+from meta_index import indexStamp, hasStamp, tempFileFor
+
+Magic = b'IXLINE01'
+Header = struct.Struct('<8sQQQ')
+# :magic, fileSize, fileMtime, numLines
+
+LineBreak = re.compile(rb'\r\n|\r|\n')
+
+
+def writeLineIndex(lineFile, docFile):
+    # scans docFile and writes the offsets of its lines to lineFile
+    reader = open(docFile, 'rb')
+    size = reader.seek(0, 2)
+    offsets = array('Q', [0])
+    if size > 0:
+        mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        for m in LineBreak.finditer(mm):
+            offsets.append(m.end())
+        mm.close()
+    reader.close()
+    if offsets[-1] < size:
+        offsets.append(size)  # :last line has no line break
+    size, mtime = indexStamp(docFile)
+    tempFile = tempFileFor(lineFile)
+    writer = open(tempFile, 'wb')
+    writer.write(Header.pack(Magic, size, mtime, len(offsets) - 1))
+    writer.write(offsets.tobytes())
+    writer.close()
+    os.replace(tempFile, lineFile)
+
+
+def isFresh(lineFile, docFile):
+    # :does lineFile exist and describe the current version of docFile?
+    return hasStamp(lineFile, docFile, Header, Magic)
+
+
+class CorpusFile:
+    # a corpus file with its line index, regenerated if missing or stale
+    def __init__(self, docFile, lineFile):
+        self.docFile = docFile
+        if not isFresh(lineFile, docFile):
+            writeLineIndex(lineFile, docFile)
+        reader = open(lineFile, 'rb')
+        head = reader.read(Header.size)
+        self.numLines = Header.unpack(head)[3]
+        self.offsets = array('Q')
+        self.offsets.frombytes(reader.read(8 * (self.numLines + 1)))
+        reader.close()
+        self.reader = open(docFile, 'rb')
+        if self.offsets[-1] > 0:
+            self.mm = mmap.mmap(self.reader.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        else:
+            self.mm = None  # :empty files can't be mapped
+
+    def getline(self, lineNo):
+        # :line lineNo (from 1) ending in '\n', or '' if there is none
+        # :(as linecache.getline)
+        if lineNo < 1 or lineNo > self.numLines:
+            return ''
+        line = self.mm[self.offsets[lineNo - 1]:self.offsets[lineNo]]
+        encoding = 'utf-8-sig' if lineNo == 1 else 'utf-8'  # :skip any BOM
+        return line.decode(encoding, 'replace').rstrip('\r\n') + '\n'
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.reader.close()
+
+
+class SnippetCache:
+    # lines of corpus files, read through CorpusFile, with the most
+    # recently read line ranges kept within maxBytes
+    def __init__(self, maxBytes, lineFilePattern='index.lines.{}'):
+        self.maxBytes = maxBytes
+        self.lineFilePattern = lineFilePattern
+        # :line index of document doc is lineFilePattern.format(doc)
+        self.files = {}  # :doc -> CorpusFile
+        self.recent = OrderedDict()  # :(doc, line, count) -> (lines, size)
+        self.currSize = 0
+
+    def corpusFile(self, doc, docFile):
+        f = self.files.get(doc)
+        if f is None or f.docFile != docFile:
+            if f is not None:
+                f.close()
+            f = CorpusFile(docFile, self.lineFilePattern.format(doc))
+            self.files[doc] = f
+        return f
+
+    def lines(self, doc, docFile, lineNo, count):
+        # :lines lineNo, ..., lineNo+count-1 of document doc
+        key = (doc, lineNo, count)
+        if key in self.recent:
+            self.recent.move_to_end(key)
+            return self.recent[key][0]
+        f = self.corpusFile(doc, docFile)
+        lines = [f.getline(lineNo + i) for i in range(count)]
+        size = sum(len(l) + 49 for l in lines)  # :rough size in memory
+        if size <= self.maxBytes:
+            self.recent[key] = (lines, size)
+            self.currSize += size
+            while self.currSize > self.maxBytes:
+                (k, (l, sz)) = self.recent.popitem(last=False)
+                self.currSize -= sz
+        return lines
+
+    def clear(self):
+        self.recent.clear()
+        self.currSize = 0
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+# End of file
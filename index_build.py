@@ -26,13 +26,84 @@ MetaIndex = {'': 0}
 # :dictionary to be populated
 # :MetaIndex[k] will give line number in IndexFile for key k
 
-MetaIndexOp = (lambda s: 0)
+def loadingMetaIndexOp(s):
+    # :initial MetaIndexOp: loads the meta-index on first use (see below)
+    ensureMetaIndex()
+    return MetaIndexOp(s)
+
+
+MetaIndexOp = loadingMetaIndexOp
+
+MetaIndexExact = True
+# :False if MetaIndexOp may give the line of another key for an absent key
+# :(as with perfect hashing), so that a wrong key means 'not found'
+
+IndexFormat = 'text'
+# :'binary' means buildIndex also writes BinaryIndexFile,
+# :and queries read postings from it instead of from IndexFile
+
+BinaryIndexFile = 'index.bin'
+
+MetaIndexFile = 'index.meta'
+# :persisted form of MetaIndex, written by buildIndex (see meta_index.py)
+
+IndexVersion = 0
+# :incremented whenever buildIndex or addDocument changes the index,
+# :so that caches of postings (search_queries.Cache) know to clear
+
+IOBackend = 'text'
+# :'bytes' means entry files are handled as undecoded lines of bytes
+# :(MappedInput, BytesOutput) when generating, sorting and merging them
+
+
+def entryInput(filename, memoryShare):
+    global IOBackend
+    if IOBackend == 'bytes':
+        return MappedInput(filename, memoryShare)
+    return BufferedInput(filename, memoryShare)
+
+
+def entryOutput(filename, memoryShare):
+    global IOBackend
+    if IOBackend == 'bytes':
+        return BytesOutput(filename, memoryShare)
+    return BufferedOutput(filename, memoryShare)
+
+
+# Memory accounting for the buffers above (see memory_budget.py):
+
+from memory_budget import MemoryBudget
+
+Budget = MemoryBudget()
+# :MemoryBudget(enforce=True) makes MemoryAllowance a cap on the real
+# :memory of buffers and their files (not just their text), as traced by
+# :tracemalloc, but not on the whole process (see memory_budget.py);
+# :trace=True reports the peak memory traced in each stage of buildIndex
+
+from pipeline_stats import Stats
+# :Stats.enabled = True counts lines, entries, runs and merge passes, and
+# :times each stage of buildIndex (see pipeline_stats.py)
+
+
+def entryKind(chunked=False):
+    # :kind of buffer used by entryInput, read by lines or by chunks
+    global IOBackend
+    if IOBackend != 'bytes':
+        return 'chunks' if chunked else 'lines'
+    return 'byteLines' if chunked else 'bytes'
+
+
+def outputKind():
+    global IOBackend
+    return 'bytes' if IOBackend == 'bytes' else 'output'
 
 
 # Initial scan to determine number of lines in a given text file:
 
 def getNumberOfLines(filename):
-    reader = BufferedInput(filename, 0.8)
+    [share] = Budget.allocate([(0.2, 'chunks')])
+    # :the entry writer (70%) is open meanwhile, as for fileWords
+    reader = BufferedInput(filename, share)
     lines = 0
     chunk = reader.readchunk()
     while chunk != []:
@@ -64,6 +135,219 @@ def getWords(s):
     return words
 
 
+# Faster tokenizer backends, giving exactly the same words as getWords:
+#   'python' : getWords applied to each line
+#   'regex'  : compiled regex applied to whole buffers of lines
+#   'numpy'  : byte classification over a memory-mapped file
+# Non-ASCII letter runs are handed back to getWords, so that the meaning
+# of 'letter' is always that of str.isalpha.
+
+import io
+import re
+import mmap
+
+numpy = None
+NumpyTried = False
+# :NumPy is imported by loadNumpy when first needed (by the 'numpy'
+# :tokenizer or RecordBuild), not on import: queries never use it, and
+# :it takes longer to import than all the rest
+
+Tokenizer = 'regex'
+# :backend used by fileWords, one of 'python', 'regex', 'numpy'
+
+KeyFilter = None
+# :if set, fileWords keeps only the words w with KeyFilter(w) true
+# :(as when building one shard of a sharded index, see sharded_index.py)
+# :it is passed to worker processes, so must be picklable (not a lambda)
+
+AsciiWordPattern = re.compile(r'[a-z]{4,}(?=[^a-z])')
+# :words in a lowercased ASCII line, needing a terminator as in getWords
+
+WordPattern = re.compile(r'[^\W\d_]{4,}')
+# :runs of letters, plus a few numeric symbols such as '\u00b2' which
+# :are not letters for str.isalpha
+
+
+def getWordsRegex(s):
+    if s.isascii():
+        return AsciiWordPattern.findall(s.lower())
+    words = WordPattern.findall(s)
+    if s[-1:].isalpha() or not all(w.isalpha() for w in words):
+        return getWords(s)  # :rare cases, left to getWords
+    return [w.casefold() for w in words]
+
+
+def wordsInRun(w, atEnd=False):
+    # :words in w, a run of ASCII letters and non-ASCII characters; if it
+    # :is atEnd of the file, its last word has no terminator, and is left
+    # :out as getWords leaves it out
+    if w.isalpha():
+        return [w.casefold()] if len(w) >= 4 and not atEnd else []
+    return getWords(w if atEnd else w + ' ')
+
+
+def lineWords(lines):
+    # :word lists, one for each line in lines, made as they are used
+    # :(the words of a whole chunk would take several times its memory)
+    global Tokenizer
+    if Tokenizer == 'python':
+        return map(getWords, lines)
+    return map(getWordsRegex, lines)
+
+
+def loadNumpy():
+    # imports NumPy on first use, with the byte tables of the 'numpy'
+    # tokenizer, and returns it (None if it is not installed)
+    global numpy, NumpyTried, WordByte, LowerByte
+    if not NumpyTried:
+        try:
+            import numpy as imported
+        except ImportError:
+            imported = None
+        if imported is not None:
+            WordByte = imported.zeros(256, dtype=bool)
+            WordByte[ord('A'):ord('Z') + 1] = True
+            WordByte[ord('a'):ord('z') + 1] = True
+            WordByte[128:] = True  # :parts of UTF-8 encoded characters
+            # :(except for U+2000 to U+203F, spaces and punctuation such as
+            # :quotes, which are caught separately)
+            LowerByte = imported.arange(256, dtype=imported.uint8)
+            LowerByte[ord('A'):ord('Z') + 1] += 32
+        numpy = imported
+        NumpyTried = True
+    return numpy
+
+
+def mappedFileWords(filename, start, end, firstLine):
+    if loadNumpy() is None:
+        raise ImportError("Tokenizer 'numpy' requires NumPy.")
+    reader = open(filename, 'rb')
+    if end is None:
+        end = reader.seek(0, 2)  # :size of file
+    if end == start:
+        reader.close()
+        return
+    mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+    data = numpy.frombuffer(mm, dtype=numpy.uint8, count=end - start,
+                            offset=start)
+    # line breaks are \n, and \r not followed by \n:
+    cr = data == 13
+    cr[:-1] &= data[1:] != 10
+    breaks = numpy.flatnonzero((data == 10) | cr)
+    # runs of word bytes, and number of non-ASCII bytes in each:
+    word = WordByte[data]
+    punct = numpy.flatnonzero((data[:-2] == 0xe2) & (data[1:-1] == 0x80))
+    word[punct] = word[punct + 1] = word[punct + 2] = False
+    edges = numpy.diff(word.view(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    high = numpy.concatenate(([0], numpy.cumsum(data >= 128)))
+    nonAscii = (high[ends] - high[starts]) > 0
+    keep = ((ends - starts >= 4) & ((ends < len(data)) | nonAscii))
+    # :shorter runs can't hold a word; an ASCII run at the very end has no
+    # :terminator, but a non-ASCII one may hold words ended by non-letters
+    starts, ends, nonAscii = starts[keep], ends[keep], nonAscii[keep]
+    if len(starts) == 0:
+        del data, cr, word
+        mm.close()
+        reader.close()
+        return
+    atEnd = int(ends[-1] == len(data))  # :1 if the last run is at the end
+    lines = numpy.searchsorted(breaks, starts) + firstLine
+    # lowercase the kept runs and join them with '\n', so that a single
+    # split gives one string per run:
+    marks = numpy.zeros(len(data) + 1, dtype=numpy.int8)
+    marks[starts] = 1
+    marks[ends] = -1  # :runs never touch, so no start is also an end
+    select = numpy.cumsum(marks[:len(data) + atEnd]) > 0
+    text = LowerByte[data]
+    if atEnd:
+        text = numpy.append(text, numpy.uint8(10))
+    text[ends] = 10
+    select[ends] = True
+    words = text[select].tobytes().decode('utf-8').split('\n')
+    last = len(starts) - 1
+    for k in numpy.flatnonzero(nonAscii).tolist():
+        words[k] = wordsInRun(words[k], atEnd and k == last)
+    # then cut the list of words into lines:
+    cuts = numpy.flatnonzero(numpy.diff(lines)) + 1
+    firsts = numpy.concatenate(([0], cuts))
+    mixed = numpy.add.reduceat(nonAscii, firsts) > 0
+    lasts = cuts.tolist() + [len(starts)]
+    for (i, j, line, n) in zip(firsts.tolist(), lasts,
+                               lines[firsts].tolist(), mixed.tolist()):
+        if not n:
+            yield (line, words[i:j])
+        else:
+            found = []
+            for w in words[i:j]:
+                if isinstance(w, list):
+                    found.extend(w)
+                else:
+                    found.append(w)
+            if found != []:
+                yield (line, found)
+    del data, cr, word
+    mm.close()
+    reader.close()
+
+
+def fileWords(filename, start=0, end=None, firstLine=1):
+    # yields (line number, words) for each line with some words, for the
+    # lines in the given byte range of the file (by default all of it)
+    global Tokenizer, KeyFilter
+    if Tokenizer == 'numpy':
+        lines = mappedFileWords(filename, start, end, firstLine)
+        if KeyFilter is not None:
+            lines = keptWords(lines, KeyFilter)
+        yield from lines
+        return
+    if start == 0 and end is None:
+        [share] = Budget.allocate([(0.2, 'chunks')])
+        reader = BufferedInput(filename, share)
+        chunks = iter(reader.readchunk, [])
+    else:
+        reader = open(filename, 'rb')
+        reader.seek(start)
+        text = reader.read(end - start).decode('utf-8')
+        chunks = [io.StringIO(text, newline=None).readlines()]
+    inlineNo = firstLine
+    for chunk in chunks:
+        for words in lineWords(chunk):
+            if KeyFilter is not None:
+                words = [w for w in words if KeyFilter(w)]
+            if words != []:
+                yield (inlineNo, words)
+            inlineNo += 1
+    reader.close()
+
+
+def keptWords(lines, keep):
+    # :lines as from fileWords, keeping only the words w with keep(w)
+    for (inlineNo, words) in lines:
+        words = [w for w in words if keep(w)]
+        if words != []:
+            yield (inlineNo, words)
+
+
+def compareTokenizers(filename='Tolstoy_War_and_Peace.txt'):
+    # times each available backend on filename, checking they all agree
+    global Tokenizer
+    import time
+    saved, results = Tokenizer, {}
+    for t in ['python', 'regex', 'numpy']:
+        if t == 'numpy' and loadNumpy() is None:
+            print('numpy'.ljust(8) + 'not available')
+            continue
+        Tokenizer = t
+        time_start = time.time()
+        results[t] = list(fileWords(filename))
+        time_end = time.time()
+        print(t.ljust(8) + format(time_end - time_start, '.3f') + 's',
+              'ok' if results[t] == results['python'] else 'MISMATCH')
+    Tokenizer = saved
+
+
 # Generation of unsorted index entries for a given textfile:
 
 import math
@@ -73,26 +357,18 @@ def generateIndexEntries(filename, filecode, writer):
     numberOfLines = getNumberOfLines(filename)
     digits = int(math.log10(numberOfLines)) + 1
     padCtrl = '0' + str(digits)  # :controls leading zero padding
-    reader = BufferedInput(filename, 0.2)
-    currline = reader.readln()
-    inlineNo = 1
     outlineNo = 0
-    while currline != None:
-        # process currline:
-        words = getWords(currline)
+    for (inlineNo, words) in fileWords(filename):
         for w in words:
             writer.writeln(w + ':' + filecode + format(inlineNo, padCtrl) + '\n')
         outlineNo += len(words)
-        # next line:
-        inlineNo += 1
-        currline = reader.readln()
-    reader.close()
     return outlineNo  # :for testing
 
 
 def generateAllIndexEntries(entryfile):
     global CorpusFiles
-    writer = BufferedOutput(entryfile, 0.7)
+    [share] = Budget.allocate([(0.7, outputKind())])
+    writer = entryOutput(entryfile, share)
     outlines = 0
     for filecode in CorpusFiles:
         outlines += generateIndexEntries(CorpusFiles[filecode], filecode, writer)
@@ -103,79 +379,278 @@ def generateAllIndexEntries(entryfile):
 # Sorting the index entries:
 
 import os
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+
+RunWorkers = 1
+# :number of worker processes used to sort runs in splitIntoSortedChunks
+# :(1 means sort in this process, as before)
 
+MergeFanIn = None
+# :maximum number of runs merged together in one pass of mergeFilesInRange
+# :None means as many as memory allows (normally all runs in a single pass)
 
-def splitIntoSortedChunks(entryfile):
-    reader = BufferedInput(entryfile, 0.3)
+MinRunBuffer = 1000
+# :smallest reader buffer (in bytes) we are willing to give each merged run
+
+
+def sortAndWriteRun(chunk, blockfile):
+    chunk.sort()
+    if chunk != [] and isinstance(chunk[0], bytes):
+        writer = open(blockfile, 'wb')
+    else:
+        writer = open(blockfile, 'w', encoding='utf-8')
+    # :output file written all at once, so no need for buffering here
+    writer.writelines(chunk)
+    writer.close()
+    return blockfile
+
+
+def splitIntoSortedChunks(entryfile, workers=None):
+    global RunWorkers
+    if workers is None:
+        workers = RunWorkers
+    fraction, kind = 0.3 / workers, entryKind(True)
+    # :with several workers, each chunk in flight gets its share of memory
+    [share] = Budget.allocate([(fraction, kind)])
+    reader = entryInput(entryfile, share)
     blockNo = 0
     chunk = reader.readchunk()
-    while chunk != []:
-        chunk.sort()
-        blockfile = open('temp_' + str(blockNo) + '_' + str(blockNo + 1), 'w',
-                         encoding='utf-8')
-        # :output file written all at once, so no need for buffering here
-        blockfile.writelines(chunk)
-        blockfile.close()
-        blockNo += 1
-        chunk = reader.readchunk()
+    Budget.measure(chunk)
+    reader.maxSize = Budget.textBytes(fraction, kind)
+    # :later chunks sized by the memory overhead measured on the first
+    if workers <= 1:
+        while chunk != []:
+            sortAndWriteRun(chunk, 'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+            blockNo += 1
+            chunk = reader.readchunk()
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = []
+            while chunk != []:
+                if len(pending) == workers:
+                    # :wait for oldest run before reading more input
+                    pending.pop(0).result()
+                pending.append(pool.submit(
+                    sortAndWriteRun, chunk,
+                    'temp_' + str(blockNo) + '_' + str(blockNo + 1)))
+                blockNo += 1
+                chunk = reader.readchunk()
+            for f in pending:
+                f.result()
     reader.close()
     return blockNo
 
 
-# TODO:
-def mergeFiles(a, b, c):
-    # Open the two files
-    reader = BufferedInput('temp_{}_{}'.format(a, b), 0.3)
-    reader1 = BufferedInput('temp_{}_{}'.format(b, c), 0.3)
-    # create the output file
-    writer = BufferedOutput('temp_{}_{}'.format(a, c), 0.3)
-    # Read first lines for each file
-    x = reader.readln()
-    y = reader1.readln()
-    while x or y:
-        # Basically Merge sort: write the smaller one in,
-        # and the index increments
+# k-way merging of sorted runs, using a heap of the current run heads:
+
+def mergeRuns(infiles, outfile):
+    n = len(infiles)
+    shares = Budget.allocate([(0.6 / n, entryKind())] * n +
+                             [(0.3, outputKind())])
+    # :readers share 60% of memory, writer 30%
+    readers = [entryInput(infiles[i], shares[i]) for i in range(n)]
+    writer = entryOutput(outfile, shares[n])
+    Stats.add('merges')
+    heap = []
+    for i in range(len(readers)):
+        x = readers[i].readln()
+        if x is not None:
+            heap.append((x, i))
+    heapq.heapify(heap)
+    while heap != []:
+        x, i = heap[0]
+        writer.writeln(x)
+        x = readers[i].readln()
         if x is None:
-            writer.writeln(y)
-            y = reader1.readln()
-        elif y is None:
-            writer.writeln(x)
-            x = reader.readln()
-        if x < y:
-            writer.writeln(x)
-            x = reader.readln()
+            heapq.heappop(heap)  # :run i is used up
         else:
-            writer.writeln(y)
-            y = reader1.readln()
-    # close files after using
-    reader.close()
-    reader1.close()
+            heapq.heapreplace(heap, (x, i))
+    for reader in readers:
+        reader.close()
     writer.flush()
     # delete the input files after merging
-    os.remove('temp_{}_{}'.format(a, b))
-    os.remove('temp_{}_{}'.format(b, c))
-    # return the name of the output file
+    for f in infiles:
+        os.remove(f)
+    return outfile
 
 
-def mergeFilesInRange(a, c):
-    # the three base cases:
+def mergeFiles(a, b, c):
+    # two-way merge of temp_a_b and temp_b_c into temp_a_c
+    return mergeRuns(['temp_{}_{}'.format(a, b), 'temp_{}_{}'.format(b, c)],
+                     'temp_{}_{}'.format(a, c))
+
+
+def maxFanIn():
+    global MergeFanIn, MinRunBuffer
+    limit = max(2, Budget.maxBuffers(0.6, MinRunBuffer, entryKind()))
+    if MergeFanIn is None:
+        return limit
+    return max(2, min(MergeFanIn, limit))
+
+
+def mergeFilesInRange(a, c, fanIn=None):
+    # merges runs temp_a_a+1, ..., temp_c-1_c into temp_a_c,
+    # taking up to fanIn runs per merge, so that each pass over the data
+    # divides the number of runs by fanIn
+    if fanIn is None:
+        fanIn = maxFanIn()
     if c - a == 0:
         return None
-    elif c - a == 1:
-        return 'temp_{}_{}'.format(a, c)
-    elif c - a == 2:
-        mergeFiles(a, a+1, c)
-        return 'temp_{}_{}'.format(a, c)
-    # we first split the task into 2 subtasks
-    p = (a + c) // 2
+    mergePasses(range(a, c + 1), fanIn)
+    return 'temp_{}_{}'.format(a, c)
 
-    # recursive call
-    mergeFilesInRange(a, p)
 
-    mergeFilesInRange(p, c)
+def runFiles(bounds, p, q):
+    # :files of runs p, ..., q-1 of bounds (see mergePasses)
+    return ['temp_{}_{}'.format(bounds[j], bounds[j + 1]) for j in range(p, q)]
+
+
+def mergePasses(bounds, fanIn, until=1):
+    # merges runs in passes taking up to fanIn runs per merge, until at
+    # most 'until' runs remain, and returns the bounds of those; the runs
+    # are given by their bounds, run j being the file temp_b_e for
+    # b, e = bounds[j], bounds[j + 1], so that the first pass over many
+    # small runs can be given a range rather than a list of them all
+    while len(bounds) - 1 > until:
+        runs = len(bounds) - 1
+        if runs - until < fanIn:
+            # :merging the first few runs is enough
+            starts = [0] + list(range(runs - until + 1, runs))
+        else:
+            starts = range(0, runs, fanIn)
+        Stats.add('mergePasses')
+        merged = []
+        for g in range(len(starts)):
+            p = starts[g]
+            q = starts[g + 1] if g + 1 < len(starts) else runs
+            if q - p > 1:
+                mergeRuns(runFiles(bounds, p, q),
+                          'temp_{}_{}'.format(bounds[p], bounds[q]))
+            merged.append(bounds[p])
+        merged.append(bounds[runs])
+        bounds = merged
+    return bounds
+
+
+# Parallel generation of pre-sorted runs, one or more per corpus shard.
+# Large files are cut into byte ranges ending at line breaks; each worker
+# tokenizes its range and spills sorted runs directly, so no raw entry file
+# (and no separate chunk sorting) is needed.
+# Line numbers are padded to a fixed width rather than one computed from
+# the length of each file, which saves the getNumberOfLines pre-pass:
+# createIndexFromEntries strips the padding off again in any case.
+
+EntryWorkers = 1
+# :number of worker processes used by buildIndex to generate entries
+# :(1 means the serial raw_entries pipeline)
+
+ShardBytes = 1000000
+# :corpus files larger than this are split into several shards
+
+LinePadDigits = 7
+# :fixed zero padding for line numbers in parallel mode
+
+
+# Worker processes started by 'spawn' or 'forkserver' (rather than 'fork')
+# import this module afresh, so they see none of the settings made since
+# it was imported (by cli.py, say, or sharded_index.buildShard); they are
+# therefore handed the current settings explicitly, and install them first.
+
+import buffered_io
+
+BuildSettings = ['IOBackend', 'Budget', 'Tokenizer', 'KeyFilter',
+                 'RunWorkers', 'MergeFanIn', 'EntryWorkers', 'ShardBytes',
+                 'LinePadDigits', 'StreamBuild', 'RecordBuild']
+# :globals affecting how an index is built (besides MemoryAllowance)
+
+
+def buildSettings():
+    # :the current build settings, for applyBuildSettings in another process
+    global BuildSettings
+    settings = {name: globals()[name] for name in BuildSettings}
+    settings['MemoryAllowance'] = buffered_io.MemoryAllowance
+    return settings
+
+
+def applyBuildSettings(settings):
+    global BuildSettings, MemoryAllowance
+    for name in BuildSettings:
+        globals()[name] = settings[name]
+    MemoryAllowance = settings['MemoryAllowance']  # :copy made by import *
+    buffered_io.MemoryAllowance = MemoryAllowance
 
-    mergeFiles(a, p, c)
-    return 'temp_{}_{}'.format(a, c)
+
+def countLines(b):
+    # :number of line breaks in b, counting \n, \r and \r\n as one each
+    # :(as for files opened in text mode)
+    return b.count(b'\n') + b.count(b'\r') - b.count(b'\r\n')
+
+
+def shardFile(filename, shardBytes):
+    # returns list of (start, end, firstLine) byte ranges covering the file
+    shards = []
+    reader = open(filename, 'rb')
+    start, firstLine = 0, 1
+    block = reader.read(shardBytes)
+    while block != b'':
+        if not block.endswith(b'\n'):
+            block += reader.readline()  # :extend shard to end of line
+        shards.append((start, start + len(block), firstLine))
+        start += len(block)
+        firstLine += countLines(block)
+        block = reader.read(shardBytes)
+    reader.close()
+    return shards
+
+
+def generateShardRuns(settings, filename, filecode, start, end, firstLine,
+                      memoryShare):
+    # tokenizes one shard, writing sorted runs of at most memoryShare bytes,
+    # with the build settings of the parent process
+    global LinePadDigits
+    applyBuildSettings(settings)
+    maxSize = Budget.textBytes(memoryShare, 'lines')
+    padCtrl = '0' + str(LinePadDigits)
+    runs, chunk, size, entries = [], [], 0, 0
+    for (inlineNo, words) in fileWords(filename, start, end, firstLine):
+        for w in words:
+            entry = w + ':' + filecode + format(inlineNo, padCtrl) + '\n'
+            if size + len(entry) + 4 > maxSize and chunk != []:
+                runs.append(sortAndWriteRun(
+                    chunk, 'temp_{}_{}_{}'.format(filecode, start, len(runs))))
+                chunk, size = [], 0
+            chunk.append(entry)
+            size += len(entry) + 4
+        entries += len(words)
+    if chunk != []:
+        runs.append(sortAndWriteRun(
+            chunk, 'temp_{}_{}_{}'.format(filecode, start, len(runs))))
+    return (runs, entries)
+
+
+def generateAllSortedRuns(workers=None):
+    # returns (number of entries, number of runs temp_0_1, temp_1_2, ...)
+    global CorpusFiles, EntryWorkers, ShardBytes
+    if workers is None:
+        workers = EntryWorkers
+    share = 0.3 / workers  # :each worker holds one run in memory
+    settings = buildSettings()
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(generateShardRuns, settings,
+                               CorpusFiles[filecode],
+                               filecode, start, end, firstLine, share)
+                   for filecode in CorpusFiles
+                   for (start, end, firstLine)
+                   in shardFile(CorpusFiles[filecode], ShardBytes)]
+        entries, blockNo = 0, 0
+        for f in futures:
+            runs, outlines = f.result()
+            entries += outlines
+            for run in runs:
+                os.replace(run, 'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+                blockNo += 1
+    return (entries, blockNo)
 
 
 # Putting it all together:
@@ -191,11 +666,31 @@ def sortRawEntries(entryfile):
 # into a single line:
 
 def createIndexFromEntries(entryfile, indexfile):
-    reader = BufferedInput(entryfile, 0.4)
-    writer = BufferedOutput(indexfile, 0.4)
+    [share] = Budget.allocate([(0.4, entryKind())])
+    reader = entryInput(entryfile, share)
+    writeIndexLines(readLines(reader), indexfile, 0.4)
+    reader.close()
+
+
+def readLines(reader):
+    # :generator of the lines of a buffered reader
     inl = reader.readln()
+    while inl is not None:
+        yield inl
+        inl = reader.readln()
+
+
+def writeIndexLines(entries, indexfile, memoryShare):
+    # writes the index lines for a sorted iterable of entries
+    [share] = Budget.allocate([(memoryShare, 'output')])
+    writer = BufferedOutput(indexfile, share)
+    pieceSize = max(writer.maxSize // 8, 100)
+    # :longer lines are written in pieces, so that the line of a frequent
+    # :key (tens of kilobytes) is never held whole
     currKey, currDoc, lineBuffer = '', '', ''
-    while inl != None:
+    for inl in entries:
+        if isinstance(inl, bytes):
+            inl = inl.decode('utf-8')
         # get keyword and ref, start ref list:
         colon = inl.index(':')
         key = inl[:colon]
@@ -208,7 +703,7 @@ def createIndexFromEntries(entryfile, indexfile):
             # new key: start a new line in index
             if key < currKey:
                 print('*** ' + key + ' out of order.\n')
-            if lineBuffer != '':
+            if currKey != '':
                 writer.writeln(lineBuffer + '\n')
             currKey = key
             currDoc = ''
@@ -223,41 +718,464 @@ def createIndexFromEntries(entryfile, indexfile):
             lineBuffer = lineBuffer + ',' + doc + line
         else:
             lineBuffer = lineBuffer + ',' + line
-        inl = reader.readln()
+        if len(lineBuffer) >= pieceSize:
+            writer.writeln(lineBuffer)
+            lineBuffer = ''
     # write last line and clean up:
     writer.writeln(lineBuffer + '\n')
     writer.flush()
-    reader.close()
 
 
-# Generating the meta-index for the index as a Python dictionary:
+# Streaming build: entries go straight from the tokenizer into a run
+# buffer in memory, which is sorted and spilled to a run file only when
+# full; the runs (or the buffer itself, if nothing was spilled) are then
+# merged directly into writeIndexLines, so neither the raw_entries file
+# nor the fully sorted entry file is written.
+
+StreamBuild = True
+# :False means the file-based pipeline (raw_entries, runs, sorted entries)
+
+
+def allEntries():
+    # :generator of the (unsorted) index entries of all corpus files
+    global CorpusFiles, LinePadDigits
+    padCtrl = '0' + str(LinePadDigits)
+    for filecode in CorpusFiles:
+        for (inlineNo, words) in fileWords(CorpusFiles[filecode]):
+            ref = ':' + filecode + format(inlineNo, padCtrl) + '\n'
+            for w in words:
+                yield w + ref
+
+
+def spillRuns(entries):
+    # collects entries into sorted runs temp_0_1, temp_1_2, ...,
+    # spilling a run whenever the buffer is full;
+    # returns (number of entries, number of runs, sorted entries not spilled)
+    maxSize = Budget.textBytes(0.6, 'lines')
+    chunk, size, count, blockNo = [], 0, 0, 0
+    for entry in entries:
+        chunk.append(entry)
+        size += len(entry)
+        if size > maxSize:
+            Budget.measure(chunk)
+            sortAndWriteRun(chunk, 'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+            blockNo += 1
+            count += len(chunk)
+            chunk, size = [], 0
+            maxSize = Budget.textBytes(0.6, 'lines')
+    count += len(chunk)
+    if blockNo > 0 and chunk != []:
+        # :the merge needs the memory, so the last run is spilled too
+        sortAndWriteRun(chunk, 'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+        blockNo += 1
+        chunk = []
+    chunk.sort()
+    return (count, blockNo, chunk)
+
+
+def mergedRuns(infiles):
+    # :generator of the lines of sorted runs, in order (deleting the runs)
+    n = len(infiles)
+    shares = Budget.allocate([(0.6 / n, entryKind())] * n)
+    readers = [entryInput(infiles[i], shares[i]) for i in range(n)]
+    Stats.add('mergePasses')
+    yield from heapq.merge(*[readLines(reader) for reader in readers])
+    for reader in readers:
+        reader.close()
+    for f in infiles:
+        os.remove(f)
+
+
+# Record build: instead of a formatted string, each entry is a record
+# (term, document, line) packed into a 64-bit integer
+#    term << 40 | doc << 32 | line
+# held in arrays, so that a run takes 8 bytes per entry on disk and is
+# sorted by a vectorized NumPy sort. Terms are numbered as they first
+# appear; a run is sorted by the order of the terms known when it is
+# spilled, which agrees with their final order, and its term numbers are
+# replaced by final ranks as it is read back for merging. Documents are
+# numbered in order of their codes. Records are turned back into text
+# only when the index lines are written.
+
+from array import array
 
-def generateMetaIndex(indexFile):
-    global MetaIndex, MetaIndexOp
+RecordBuild = False
+# :True means buildIndex sorts records rather than strings (needs NumPy)
+
+RecordCost = 48
+# :peak bytes per entry while a run is collected and sorted
+# :(9 in the collecting arrays, the rest for the sort's temporaries)
+
+TermShift, DocShift = 40, 32
+LineMask, LowMask = (1 << 32) - 1, (1 << 40) - 1
+
+
+def termRanks(terms):
+    # :rank[i] is the position of terms[i] in sorted order
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    rank = numpy.empty(len(terms), dtype=numpy.uint64)
+    rank[order] = numpy.arange(len(terms), dtype=numpy.uint64)
+    return rank
+
+
+def sortRecords(terms, termArr, docArr, lineArr, blockfile=None):
+    # sorts the collected records by the order of the terms known so far;
+    # writes them (with term numbers, not ranks) to blockfile if given,
+    # otherwise returns them sorted (with ranks)
+    rank = termRanks(terms)
+    ids = numpy.frombuffer(termArr, dtype=numpy.uint32).astype(numpy.uint64)
+    low = ((numpy.frombuffer(docArr, dtype=numpy.uint8).astype(numpy.uint64)
+            << numpy.uint64(DocShift)) |
+           numpy.frombuffer(lineArr, dtype=numpy.uint32))
+    keys = (rank[ids] << numpy.uint64(TermShift)) | low
+    if blockfile is None:
+        keys.sort()
+        return keys
+    order = numpy.argsort(keys, kind='stable')
+    del keys
+    ((ids << numpy.uint64(TermShift)) | low)[order].tofile(blockfile)
+    return None
+
+
+def collectRecords():
+    # tokenizes all corpus files into records, spilling sorted runs
+    # temp_0_1, temp_1_2, ... when the arrays are full;
+    # returns (number of entries, number of runs, terms in order of
+    # their numbers, sorted keys of any records not spilled)
+    global CorpusFiles
+    if loadNumpy() is None:
+        raise ImportError('RecordBuild requires NumPy.')
+    docCodes = sorted(CorpusFiles)
+    if len(docCodes) > 256:
+        raise Exception('Too many documents for records: ' +
+                        str(len(docCodes)))
+    maxRecords = max(1, Budget.textBytes(0.6, 'bytes') // RecordCost)
+    termIds, terms = {}, []
+    termArr, docArr, lineArr = array('I'), array('B'), array('I')
+    entries, blockNo = 0, 0
+    for filecode in CorpusFiles:
+        doc = bytes([docCodes.index(filecode)])
+        for (inlineNo, words) in fileWords(CorpusFiles[filecode]):
+            for w in words:
+                i = termIds.get(w)
+                if i is None:
+                    i = termIds[w] = len(terms)
+                    terms.append(w)
+                termArr.append(i)
+            docArr.frombytes(doc * len(words))
+            lineArr.extend([inlineNo] * len(words))
+            if len(termArr) >= maxRecords:
+                sortRecords(terms, termArr, docArr, lineArr,
+                            'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+                blockNo += 1
+                entries += len(termArr)
+                termArr, docArr, lineArr = array('I'), array('B'), array('I')
+    if len(terms) >> (64 - TermShift) > 0:
+        raise Exception('Too many terms for records: ' + str(len(terms)))
+    entries += len(termArr)
+    if blockNo > 0 and len(termArr) > 0:
+        # :the merge needs the memory, so the last run is spilled too
+        sortRecords(terms, termArr, docArr, lineArr,
+                    'temp_' + str(blockNo) + '_' + str(blockNo + 1))
+        blockNo += 1
+    if blockNo > 0:
+        return (entries, blockNo, terms, None)
+    return (entries, 0, terms, sortRecords(terms, termArr, docArr, lineArr))
+
+
+class RecordReader:
+    # reads a run of records in blocks, replacing term numbers by ranks
+    # if rank is given
+    def __init__(self, filename, memoryShare, rank=None):
+        self.filename = filename
+        self.reader = open(filename, 'rb')
+        self.blockSize = max(1, int(memoryShare *
+                                    buffered_io.MemoryAllowance) // 8)
+        self.rank = rank
+
+    def next(self):
+        # :next block of keys, or None at end of run
+        keys = numpy.fromfile(self.reader, dtype=numpy.uint64,
+                              count=self.blockSize)
+        if len(keys) == 0:
+            return None
+        if self.rank is not None:
+            keys = ((self.rank[keys >> numpy.uint64(TermShift)]
+                     << numpy.uint64(TermShift)) |
+                    (keys & numpy.uint64(LowMask)))
+        return keys
+
+    def close(self):
+        self.reader.close()
+
+
+def mergeRecordBlocks(readers):
+    # generator of sorted blocks of keys merging the runs of readers:
+    # each round takes, from every run, the keys up to the smallest of
+    # the last keys of the blocks held, so at least one block is used up
+    active = []
+    for reader in readers:
+        block = reader.next()
+        if block is not None:
+            active.append([reader, block])
+    while active != []:
+        bound = min(block[-1] for (reader, block) in active)
+        parts = []
+        for run in active:
+            cut = numpy.searchsorted(run[1], bound, side='right')
+            parts.append(run[1][:cut])
+            run[1] = run[1][cut:]
+            if len(run[1]) == 0:
+                run[1] = run[0].next()
+        active = [run for run in active if run[1] is not None]
+        block = numpy.concatenate(parts)
+        block.sort()
+        yield block
+    for reader in readers:
+        reader.close()
+        os.remove(reader.filename)
+
+
+def recordBlocks(runs, rank):
+    # sorted blocks of keys (with ranks) from runs temp_0_1, ...,
+    # first merging runs in passes if there are too many to merge at once
+    fanIn = max(2, Budget.maxBuffers(0.6, MinRunBuffer, 'bytes'))
+    runs = [(i, i + 1, rank) for i in range(runs)]
+    while len(runs) > fanIn:
+        Stats.add('mergePasses')
+        merged = []
+        for g in range(0, len(runs), fanIn):
+            group = runs[g:g + fanIn]
+            if len(group) > 1:
+                outfile = 'temp_{}_{}'.format(group[0][0], group[-1][1])
+                writer = open(outfile + '_', 'wb')
+                for block in mergeRecordBlocks(recordReaders(group)):
+                    block.tofile(writer)
+                writer.close()
+                os.replace(outfile + '_', outfile)
+                merged.append((group[0][0], group[-1][1], None))
+            else:
+                merged.append(group[0])
+        runs = merged
+    Stats.add('mergePasses')
+    return mergeRecordBlocks(recordReaders(runs))
+
+
+def recordReaders(runs):
+    n = len(runs)
+    shares = Budget.allocate([(0.6 / n, 'bytes')] * n)
+    return [RecordReader('temp_{}_{}'.format(b, e), shares[i], rank)
+            for (i, (b, e, rank)) in enumerate(runs)]
+
+
+def recordLines(keys, sortedTerms, docCodes):
+    # index lines for sorted keys covering whole terms
+    if len(keys) == 0:
+        return []
+    groups = keys >> numpy.uint64(DocShift)  # :term and doc
+    starts = numpy.flatnonzero(groups[1:] != groups[:-1]) + 1
+    bounds = [0] + starts.tolist() + [len(keys)]
+    lineStrs = list(map(str, (keys & numpy.uint64(LineMask)).tolist()))
+    lines, refs, currTerm = [], [], None
+    groupList = groups[bounds[:-1]].tolist()
+    for j in range(len(groupList)):
+        term, doc = groupList[j] >> 8, groupList[j] & 0xff
+        if term != currTerm:
+            if refs != []:
+                lines.append(sortedTerms[currTerm] + ':' +
+                             ','.join(refs) + '\n')
+            currTerm, refs = term, []
+        refs.append(docCodes[doc] +
+                    ','.join(lineStrs[bounds[j]:bounds[j + 1]]))
+    lines.append(sortedTerms[currTerm] + ':' + ','.join(refs) + '\n')
+    return lines
+
+
+def writeRecordIndex(runs, terms, keys, indexfile, memoryShare):
+    # writes the index lines for the records in runs, or in keys if
+    # nothing was spilled; blocks are cut before their last term, which
+    # may continue in the next block
+    global CorpusFiles
+    docCodes = sorted(CorpusFiles)
+    sortedTerms = sorted(terms)
+    if runs > 0:
+        blocks = recordBlocks(runs, termRanks(terms))
+    else:
+        blocks = [keys]
+    [share] = Budget.allocate([(memoryShare, 'output')])
+    writer = BufferedOutput(indexfile, share)
+    pending = numpy.empty(0, dtype=numpy.uint64)
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        keys = numpy.concatenate((pending, block))
+        cut = numpy.searchsorted(keys >> numpy.uint64(TermShift),
+                                 keys[-1] >> numpy.uint64(TermShift))
+        pending = keys[cut:]
+        for line in recordLines(keys[:cut], sortedTerms, docCodes):
+            writer.writeln(line)
+    for line in recordLines(pending, sortedTerms, docCodes):
+        writer.writeln(line)
+    writer.flush()
+
+
+# Generating the meta-index for the index as a Python dictionary,
+# optionally persisting it to metaFile for later use by loadMetaIndex:
+
+from meta_index import MappedMetaIndex, writeMetaIndexFile, isFresh
+
+
+def generateMetaIndex(indexFile, metaFile=None):
+    global MetaIndex, MetaIndexOp, MetaIndexExact, SortedKeysCache
+    if not isinstance(MetaIndex, dict):
+        MetaIndex.close()
+        MetaIndex = {}
     MetaIndex.clear()
-    reader = BufferedInput(indexFile, 0.9)
-    indexline = 1
-    inl = reader.readln()
-    while inl != None:
-        key = inl[:inl.index(':')]
-        MetaIndex[key] = indexline
-        indexline += 1
+    SortedKeysCache = None
+    if metaFile is not None:
+        keys = writeMetaIndexFile(metaFile, indexFile)
+        for i in range(len(keys)):
+            MetaIndex[keys[i]] = i + 1
+    else:
+        [share] = Budget.allocate([(0.9, 'lines')])
+        reader = BufferedInput(indexFile, share)
+        indexline = 1
         inl = reader.readln()
-    reader.close()
+        while inl != None:
+            key = inl[:inl.index(':')]
+            MetaIndex[key] = indexline
+            indexline += 1
+            inl = reader.readln()
+        reader.close()
     MetaIndexOp = (lambda s: MetaIndex[s])
+    MetaIndexExact = True
+
+
+def loadMetaIndex(indexFile, metaFile=None):
+    # installs the persisted meta-index for indexFile as MetaIndex,
+    # first regenerating it if it is missing or older than indexFile
+    global MetaIndex, MetaIndexOp, MetaIndexExact, MetaIndexFile
+    if metaFile is None:
+        metaFile = MetaIndexFile
+    if not isFresh(metaFile, indexFile):
+        writeMetaIndexFile(metaFile, indexFile)
+    # :the new MetaIndex is installed before MetaIndexOp, so that queries
+    # running meanwhile never see a half-built one
+    previous = MetaIndex
+    MetaIndex = MappedMetaIndex(metaFile, indexFile)
+    MetaIndexOp = (lambda s: MetaIndex[s])
+    MetaIndexExact = True
+    if not isinstance(previous, dict):
+        previous.close()
+
+
+import threading
+
+MetaIndexLock = threading.Lock()
+# :so that concurrent first queries load the meta-index only once
+
+
+def ensureMetaIndex():
+    # loads the persisted meta-index for IndexFile, unless some MetaIndex
+    # has been generated or installed already; importing this module thus
+    # reads nothing, and the first query pays for loading
+    global IndexFile, MetaIndexOp, MetaIndexLock
+    if MetaIndexOp is loadingMetaIndexOp:
+        with MetaIndexLock:
+            if MetaIndexOp is loadingMetaIndexOp:  # :not loaded meanwhile
+                loadMetaIndex(IndexFile)
+
+
+# A front-coded term dictionary (see term_dictionary.py) can serve as
+# MetaIndex instead, at a fraction of the memory of the dictionary:
+
+import term_dictionary
+from term_dictionary import TermDictionary
+
+TermDictFile = 'index.terms'
+
+
+def loadTermDictionary(indexFile, dictFile=None):
+    # installs the term dictionary for indexFile as MetaIndex,
+    # first regenerating it if it is missing or older than indexFile
+    global MetaIndex, MetaIndexOp, MetaIndexExact, TermDictFile
+    if dictFile is None:
+        dictFile = TermDictFile
+    if not isinstance(MetaIndex, dict):
+        MetaIndex.close()
+        MetaIndex = {}
+    if not term_dictionary.isFresh(dictFile, indexFile):
+        term_dictionary.writeTermDictionary(dictFile, indexFile)
+    MetaIndex = TermDictionary(dictFile, indexFile)
+    MetaIndexOp = (lambda s: MetaIndex[s])
+    MetaIndexExact = True
 
 
 def buildIndex():
-    rawEntryFile = 'raw_entries'
-    entries = generateAllIndexEntries(rawEntryFile)
-    sortedEntryFile = sortRawEntries(rawEntryFile)
-    global IndexFile
-    createIndexFromEntries(sortedEntryFile, IndexFile)
-    generateMetaIndex(IndexFile)
-    os.remove(rawEntryFile)
-    os.remove(sortedEntryFile)
+    global IndexFile, EntryWorkers, IndexFormat, BinaryIndexFile, MetaIndexFile
+    global StreamBuild, RecordBuild, IndexVersion
+    chunk = []  # :sorted entries kept in memory by spillRuns
+    if RecordBuild:
+        Budget.start('runs')
+        entries, chunks, terms, keys = collectRecords()
+    elif EntryWorkers > 1:
+        Budget.start('runs')
+        entries, chunks = generateAllSortedRuns(EntryWorkers)
+    elif StreamBuild:
+        Budget.start('runs')
+        entries, chunks, chunk = spillRuns(allEntries())
+    else:
+        rawEntryFile = 'raw_entries'
+        Budget.start('entries')
+        entries = generateAllIndexEntries(rawEntryFile)
+        Budget.stop()
+        Budget.start('split')
+        chunks = splitIntoSortedChunks(rawEntryFile)
+        os.remove(rawEntryFile)
+    Budget.stop()
+    Stats.add('entriesEmitted', entries)
+    Stats.add('runs', chunks)
+    if RecordBuild:
+        Budget.start('index')
+        writeRecordIndex(chunks, terms, keys, IndexFile, 0.3)
+        Budget.stop()
+        del terms, keys
+    elif StreamBuild:
+        fanIn = maxFanIn()
+        Budget.start('merge')
+        bounds = mergePasses(range(chunks + 1), fanIn, fanIn)
+        Budget.stop()
+        Budget.start('index')
+        if chunks == 0:
+            writeIndexLines(chunk, IndexFile, 0.3)
+        else:
+            writeIndexLines(mergedRuns(runFiles(bounds, 0, len(bounds) - 1)),
+                            IndexFile, 0.3)
+        Budget.stop()
+    else:
+        Budget.start('merge')
+        sortedEntryFile = mergeFilesInRange(0, chunks)
+        Budget.stop()
+        Budget.start('index')
+        createIndexFromEntries(sortedEntryFile, IndexFile)
+        Budget.stop()
+        os.remove(sortedEntryFile)
+    del chunk
+    Budget.start('meta')
+    generateMetaIndex(IndexFile, MetaIndexFile)
+    Budget.stop()
+    if IndexFormat == 'binary':
+        Budget.start('binary')
+        writeBinaryIndex()
+        Budget.stop()
+    IndexVersion += 1
+    linecache.checkcache(IndexFile)  # :drops lines of the old index
     print('Success! ' + str(len(MetaIndex)) + ' keys, ' +
           str(entries) + ' entries.')
+    if Budget.enforce or Budget.trace:
+        Budget.report()
+    if Stats.enabled:
+        Stats.report()
 
 
 # Accessing the index using 'linecache' (random access to text files by line):
@@ -266,26 +1184,280 @@ import linecache
 
 
 def indexEntryFor(key):
-    global IndexFile, MetaIndex, MetaIndexOp
+    global IndexFile, MetaIndex, MetaIndexOp, MetaIndexExact
     try:
         lineNo = MetaIndexOp(key)  # :allows for other meta-indexing schemes
-        indexLine = linecache.getline(IndexFile, lineNo)
     except KeyError:
         return None
+    if isinstance(MetaIndex, (MappedMetaIndex, TermDictionary)):
+        indexLine = MetaIndex.lineAt(lineNo)  # :reads just this line
+    else:
+        indexLine = linecache.getline(IndexFile, lineNo)
     colon = indexLine.index(':')
     if indexLine[:colon] == key:
         return indexLine[colon + 1:]
+    elif not MetaIndexExact:
+        return None
     else:
         raise Exception('Wrong key in index line.')
 
 
+# Accessing the binary index (see binary_index.py), opened on first use:
+
+from binary_index import BinaryIndex, createBinaryIndex
+
+BinaryIndexReader = None
+
+
+def binaryIndex():
+    global BinaryIndexFile, BinaryIndexReader
+    if BinaryIndexReader is None:
+        BinaryIndexReader = BinaryIndex(BinaryIndexFile)
+    return BinaryIndexReader
+
+
+def closeBinaryIndex():
+    global BinaryIndexReader
+    if BinaryIndexReader is not None:
+        BinaryIndexReader.close()
+        BinaryIndexReader = None
+
+
+def writeBinaryIndex():
+    # :(re)writes BinaryIndexFile from IndexFile, with buffers from Budget
+    global IndexFile, BinaryIndexFile
+    closeBinaryIndex()
+    shares = Budget.allocate([(0.4, 'lines'), (0.3, 'bytes')])
+    createBinaryIndex(IndexFile, BinaryIndexFile, shares)
+
+
+# Expanding prefix and wildcard patterns ('abando*', 'wom?n') into the
+# keys they match, by binary search over the keys in sorted order for the
+# literal part before the first wildcard, then scanning forward from there.
+# Keys are in sorted order already in a persisted meta-index or term
+# dictionary; for a dictionary MetaIndex a sorted list is made once.
+
+import bisect
+import fnmatch
+
+MaxExpansion = 50
+# :most keys a pattern is expanded to; later matches are ignored
+
+WildcardChars = '*?['
+# :as for fnmatch
+
+
+class SortedKeys:
+    # :the keys of a meta-index as a sorted sequence (usable by bisect)
+    def __init__(self, metaIndex):
+        self.metaIndex = metaIndex
+        if isinstance(metaIndex, MappedMetaIndex):
+            self.keyAt = metaIndex.key
+        elif isinstance(metaIndex, TermDictionary):
+            self.keyAt = metaIndex.term
+        else:
+            self.keyAt = sorted(metaIndex).__getitem__
+        self.n = len(metaIndex)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.keyAt(i)
+
+    def keysFrom(self, i):
+        # :generator of the keys from position i on
+        if isinstance(self.metaIndex, TermDictionary):
+            yield from self.metaIndex.termsFrom(i)
+        else:
+            for j in range(i, self.n):
+                yield self.keyAt(j)
+
+
+SortedKeysCache = None
+
+
+def sortedKeys():
+    global MetaIndex, SortedKeysCache
+    ensureMetaIndex()
+    if SortedKeysCache is None or SortedKeysCache.metaIndex is not MetaIndex:
+        SortedKeysCache = SortedKeys(MetaIndex)
+    return SortedKeysCache
+
+
+def isPattern(key):
+    global WildcardChars
+    return any(c in key for c in WildcardChars)
+
+
+def expandPattern(pattern, limit=None, keys=None):
+    # returns (keys matching pattern, in order, and whether more than
+    # limit keys match, in which case only the first limit are returned);
+    # keys is a SortedKeys to search, by default that of MetaIndex
+    global WildcardChars
+    prefix = pattern
+    for c in WildcardChars:
+        prefix = prefix.split(c)[0]
+    match = re.compile(fnmatch.translate(pattern)).match
+    if keys is None:
+        keys = sortedKeys()
+    found = []
+    for key in keys.keysFrom(bisect.bisect_left(keys, prefix)):
+        if not key.startswith(prefix):
+            break
+        if match(key):
+            if len(found) == limit:
+                return (found, True)
+            found.append(key)
+    return (found, False)
+
+
+# Adding a new document to an existing index, without a full rebuild:
+# the new file is indexed on its own, its index lines are merged into
+# IndexFile in one sequential pass, and the meta-index is then rewritten
+# from the keys and line offsets gathered during that pass.
+# Within each index line, documents appear in order of their codes
+# (as entries are sorted), so the new document's postings are inserted
+# before the first document whose code comes after it.
+
+from meta_index import writeMetaIndex
+
+DocStart = re.compile(r',(?=[^\W\d_])')
+# :a comma starting the postings of another document
+
+
+def insertDocPostings(postings, doc, docPostings):
+    # 'ABC01,23,XYZ4', 'DEF', 'DEF5,6' -> 'ABC01,23,DEF5,6,XYZ4'
+    if doc < postings[:3]:
+        return docPostings + ',' + postings
+    for m in DocStart.finditer(postings):
+        if doc < postings[m.end():m.end() + 3]:
+            return (postings[:m.start()] + ',' + docPostings +
+                    postings[m.start():])
+    return postings + ',' + docPostings
+
+
+def indexKey(inl):
+    # :key of an index line (None at end of file)
+    if inl is None:
+        return None
+    return inl[:inl.index(':')]
+
+
+def mergeIndexFiles(indexFile, newIndexFile, outFile):
+    # merges two index files covering different documents into outFile,
+    # where newIndexFile has one document only;
+    # returns the keys of outFile in order and the byte offset of each line
+    shares = Budget.allocate([(0.3, 'lines'), (0.3, 'lines'), (0.3, 'bytes')])
+    old = BufferedInput(indexFile, shares[0])
+    new = BufferedInput(newIndexFile, shares[1])
+    writer = BytesOutput(outFile, shares[2])
+    # :written as bytes, so that line offsets are known exactly
+    keys, lineOffsets = [], array('Q')
+    offset = 0
+    a, b = old.readln(), new.readln()
+    keyA, keyB = indexKey(a), indexKey(b)
+    while a is not None or b is not None:
+        if b is None or (a is not None and keyA < keyB):
+            key, line = keyA, a
+            a = old.readln()
+            keyA = indexKey(a)
+        elif a is None or keyB < keyA:
+            key, line = keyB, b
+            b = new.readln()
+            keyB = indexKey(b)
+        else:
+            # same key: insert the new document's postings
+            colon = len(keyA) + 1
+            key = keyA
+            docPostings = b[colon:].rstrip('\n')
+            line = (key + ':' + insertDocPostings(a[colon:].rstrip('\n'),
+                                                  docPostings[:3],
+                                                  docPostings) + '\n')
+            a, b = old.readln(), new.readln()
+            keyA, keyB = indexKey(a), indexKey(b)
+        if not line.endswith('\n'):
+            line += '\n'
+        data = line.encode('utf-8')
+        writer.writeln(data)
+        keys.append(key)
+        lineOffsets.append(offset)
+        offset += len(data)
+    old.close()
+    new.close()
+    writer.flush()
+    return (keys, lineOffsets)
+
+
+def patchMetaIndex(keys, lineOffsets):
+    # installs the meta-index of the updated IndexFile, in the same form
+    # (dictionary, persisted or term dictionary) as before
+    global IndexFile, MetaIndex, MetaIndexOp, MetaIndexExact, MetaIndexFile
+    global TermDictFile
+    linecache.checkcache(IndexFile)  # :forget lines of the old index
+    terms = isinstance(MetaIndex, TermDictionary)
+    persisted = not terms and not isinstance(MetaIndex, dict)
+    if persisted or os.path.exists(MetaIndexFile):
+        writeMetaIndex(MetaIndexFile, IndexFile, keys, lineOffsets)
+    # :the files are replaced atomically (see meta_index.py), and the old
+    # :MetaIndex is closed only once the new one is installed, as in
+    # :loadMetaIndex
+    previous = MetaIndex
+    if terms:
+        term_dictionary.writeTermDictionary(TermDictFile, IndexFile, keys,
+                                            lineOffsets=lineOffsets)
+        MetaIndex = TermDictionary(TermDictFile, IndexFile)
+    elif persisted:
+        MetaIndex = MappedMetaIndex(MetaIndexFile, IndexFile)
+    else:
+        newMetaIndex = {}
+        for i in range(len(keys)):
+            newMetaIndex[keys[i]] = i + 1
+        MetaIndex = newMetaIndex
+    MetaIndexOp = (lambda s: MetaIndex[s])
+    MetaIndexExact = True
+    if not isinstance(previous, dict):
+        previous.close()
+
+
+def addDocument(filecode, filename):
+    global CorpusFiles, IndexFile, IndexFormat, BinaryIndexFile, IndexVersion
+    if filecode in CorpusFiles:
+        raise Exception('Document code already in use: ' + filecode)
+    ensureMetaIndex()  # :for the form of meta-index to keep
+    rawEntryFile, newIndexFile = 'new_entries', 'new_index'
+    [share] = Budget.allocate([(0.7, outputKind())])
+    writer = entryOutput(rawEntryFile, share)
+    entries = generateIndexEntries(filename, filecode, writer)
+    writer.flush()
+    if entries == 0:
+        os.remove(rawEntryFile)  # :nothing to add to the index
+        CorpusFiles[filecode] = filename
+        return 0
+    sortedEntryFile = sortRawEntries(rawEntryFile)
+    os.remove(rawEntryFile)
+    createIndexFromEntries(sortedEntryFile, newIndexFile)
+    os.remove(sortedEntryFile)
+    keys, lineOffsets = mergeIndexFiles(IndexFile, newIndexFile, 'temp_index')
+    os.remove(newIndexFile)
+    os.replace('temp_index', IndexFile)
+    CorpusFiles[filecode] = filename
+    # :registered only now, so that if any step above fails the corpus
+    # :lists no document missing from the index
+    patchMetaIndex(keys, lineOffsets)
+    if IndexFormat == 'binary':
+        writeBinaryIndex()
+    IndexVersion += 1
+    linecache.checkcache(IndexFile)
+    print('Added ' + filecode + ': ' + str(len(keys)) + ' keys, ' +
+          str(entries) + ' entries.')
+    return entries
+
+
 # End of file
-# import time
-# time_start=time.time()
-# buildIndex()
-# time_end=time.time()
-# print('totally cost',time_end-time_start)
-
-generateAllIndexEntries('raw_entries')
-splitIntoSortedChunks('raw_entries')
-buildIndex()
\ No newline at end of file
+if __name__ == '__main__':
+    import time
+    time_start=time.time()
+    buildIndex()
+    time_end=time.time()
+    print('totally cost',time_end-time_start)
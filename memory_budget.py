@@ -0,0 +1,157 @@
+# Python source file: memory_budget.py
+
+# Accounting for the memory really used by buffers.
+# A memoryShare given to BufferedInput etc. counts characters of text,
+# but a list of Python strings costs several times its text: each str has
+# a header of about 49 bytes (33 for bytes), the list holds a pointer to
+# each, BufferedOutput also preallocates a pointer per 10 bytes, and
+# readchunk reads the next chunk ahead. Each open file also has buffers
+# of its own (a few times io.DEFAULT_BUFFER_SIZE in text mode).
+# A MemoryBudget estimates this overhead by sampling sys.getsizeof over
+# lines actually read, divides MemoryAllowance between the buffers that
+# are open at the same time, and (if enforce is set) scales their shares
+# down so that their real footprint, not just their text, stays within
+# the allowance. It also records, for each stage of a pipeline, the most
+# buffer memory planned at once, and the peak traced by tracemalloc if
+# trace is set (tracing slows Python down, so it is off by default;
+# note that memory of worker processes is not traced). Its stages are
+# also timed (and profiled) by pipeline_stats.Stats, if that is enabled.
+# Enforcement bounds the buffers, with FileCost calibrated against
+# tracemalloc, and not the whole process: memory held outside buffers
+# is not counted, such as the MetaIndex built by the meta stage, the
+# words of the line being tokenized, the heap of a merge, the in-memory
+# runs of a record build, or worker processes. At a small allowance the
+# buffered stages of a build thus peak near it (and meta, holding the
+# MetaIndex, well above it), at the price of more runs and merge passes.
+
+import io
+import sys
+import time
+import tracemalloc
+
+import buffered_io
+from pipeline_stats import Stats
+
+AssumedLineLength = 16
+# :typical length of an index entry line, used until lines are sampled
+
+Overhead = {'lines': (sys.getsizeof('') + 8) / AssumedLineLength + 1,
+            'byteLines': (sys.getsizeof(b'') + 8) / AssumedLineLength + 1,
+            'bytes': 1.0}
+# :default memory per byte of text held, for each kind of buffer:
+# :'lines' is a list of str, 'byteLines' a list of bytes,
+# :'bytes' a bytearray or memory-mapped file
+# :(also 'chunks' for BufferedInput read by chunks, 'output' for
+# :BufferedOutput; these are derived from 'lines')
+
+OutputSlots = 8 / 10
+# :pointer memory per byte of BufferedOutput's preallocated buffer
+
+FileCost = {'lines': int(4.5 * io.DEFAULT_BUFFER_SIZE),
+            'chunks': int(4.5 * io.DEFAULT_BUFFER_SIZE),
+            'output': int(4.5 * io.DEFAULT_BUFFER_SIZE),
+            'byteLines': io.DEFAULT_BUFFER_SIZE,
+            'bytes': io.DEFAULT_BUFFER_SIZE}
+# :memory of the open file underlying each kind of buffer, at its peak
+# :as traced by tracemalloc (CPython 3.11): a text file holds its binary
+# :buffer, a chunk of decoded text, and (when writing) the strings pending
+# :for a chunk
+
+MinBufferText = 1000
+# :no buffer is given less text than this, whatever the cap
+
+
+class MemoryBudget:
+    def __init__(self, enforce=False, trace=False):
+        self.enforce = enforce
+        self.trace = trace
+        self.overhead = dict(Overhead)
+        self.stages = {}  # :name -> [seconds, planned bytes, traced peak]
+        self.current = None
+
+    def measure(self, lines, samples=100):
+        # updates the overhead for this kind of line from a sample of lines,
+        # returning memory per byte of text
+        if lines == []:
+            return None
+        kind = 'byteLines' if isinstance(lines[0], bytes) else 'lines'
+        step = max(1, len(lines) // samples)
+        text, used = 0, 0
+        for i in range(0, len(lines), step):
+            text += len(lines[i])
+            used += sys.getsizeof(lines[i]) + 8  # :8 for the list's pointer
+        self.overhead[kind] = used / text
+        return self.overhead[kind]
+
+    def factor(self, kind):
+        # :memory per byte of text for buffer kind ('output' is BufferedOutput)
+        if kind == 'output':
+            return self.overhead['lines'] + OutputSlots
+        if kind == 'chunks':
+            return 2 * self.overhead['lines']
+        return self.overhead[kind]
+
+    def allocate(self, requests):
+        # requests is a list of (fraction of MemoryAllowance, kind)
+        # for buffers to be open at the same time; returns their memoryShares
+        allowance = buffered_io.MemoryAllowance
+        shares = []
+        planned = 0
+        for (fraction, kind) in requests:
+            if self.enforce:
+                text = ((fraction * allowance - FileCost[kind]) /
+                        self.factor(kind))
+                share = max(text, MinBufferText) / allowance
+            else:
+                share = fraction
+            shares.append(share)
+            planned += share * allowance * self.factor(kind) + FileCost[kind]
+        if self.current is not None:
+            record = self.stages[self.current]
+            record[1] = max(record[1], int(planned))
+        return shares
+
+    def maxBuffers(self, fraction, minText, kind):
+        # :how many buffers of this kind, each holding at least minText
+        # :bytes of text, fit in this fraction of memory
+        if self.enforce:
+            each = minText * self.factor(kind) + FileCost[kind]
+        else:
+            each = minText
+        return int(fraction * buffered_io.MemoryAllowance // each)
+
+    def textBytes(self, fraction, kind):
+        # :size in bytes of text for one buffer with this fraction
+        return int(self.allocate([(fraction, kind)])[0] *
+                   buffered_io.MemoryAllowance)
+
+    def start(self, name):
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self.stages[name] = [time.perf_counter(), 0, None]
+        self.current = name
+        Stats.start(name)
+
+    def stop(self):
+        Stats.stop()
+        record = self.stages[self.current]
+        record[0] = time.perf_counter() - record[0]
+        if self.trace:
+            record[2] = tracemalloc.get_traced_memory()[1]
+        self.current = None
+
+    def report(self):
+        print('Memory allowance ' + str(buffered_io.MemoryAllowance) +
+              (' (enforced)' if self.enforce else ''))
+        for name in self.stages:
+            seconds, planned, peak = self.stages[name]
+            line = (name.ljust(10) + format(seconds, '8.2f') + 's' +
+                    '  buffers ' + str(planned))
+            if peak is not None:
+                line += '  traced peak ' + str(peak)
+            print(line)
+
+
+# End of file
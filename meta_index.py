@@ -0,0 +1,198 @@
+# Python source file: meta_index.py
+
+# A persisted meta-index, so that query processes need not rescan the
+# whole index file at startup.
+# Line i+1 of the index file holds key i, so the sorted array of keys
+# determines the line numbers; we also store the byte offset of each line,
+# allowing an index entry to be read without loading the whole index.
+# The file is memory-mapped on loading, and keys are looked up by binary
+# search, so loading costs the same however large the index is.
+
+# File layout:
+#    header     : magic, size and mtime of the index file, numKeys,
+#                 and offsets of the sections below
+#    keys       : UTF-8 keys concatenated
+#    keyStart   : numKeys+1 uint64 offsets into keys
+#    lineOffset : numKeys uint64 byte offsets of the index lines
+
+import os
+import mmap
+import struct
+from array import array
+
+Magic = b'IXMETA01'
+Header = struct.Struct('<8sQQQQQQ')
+# :magic, indexSize, indexMtime, numKeys, keysOffset,
+# :keyStartOffset, lineOffsetOffset
+
+
+# Persisted files (meta-index, term dictionary, binary index, line
+# indexes) are written under a temporary name and then renamed over the
+# old file with os.replace: a process that has the old file mapped keeps
+# it, consistent with the index file it opened, and no process ever maps
+# a file that is only half written (or truncated under it).
+
+def tempFileFor(filename):
+    # :temporary name to write filename under (unique to this process)
+    return filename + '.' + str(os.getpid()) + '.tmp'
+
+
+def indexStamp(indexFile):
+    # :(size, mtime) of the index file, used to detect a stale meta-index
+    st = os.stat(indexFile)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def hasStamp(filename, sourceFile, header, magic):
+    # does filename exist and describe the current version of sourceFile?
+    # filename starts with header (a struct.Struct) holding magic and the
+    # indexStamp of sourceFile it was made from; this is shared by the
+    # meta-index, the term dictionary and corpus line indexes
+    try:
+        reader = open(filename, 'rb')
+    except FileNotFoundError:
+        return False
+    head = reader.read(header.size)
+    reader.close()
+    if len(head) < header.size:
+        return False
+    found, size, mtime = header.unpack(head)[:3]
+    return found == magic and (size, mtime) == indexStamp(sourceFile)
+
+
+def readIndexLine(indexReader, start, end):
+    # line of the index file at bytes start..end, read directly from the
+    # file (by pread, so that threads may share the reader)
+    line = os.pread(indexReader.fileno(), end - start, start)
+    line = line.decode('utf-8')
+    if line.endswith('\r\n'):
+        line = line[:-2] + '\n'  # :as when read in text mode
+    return line
+
+
+def writeMetaIndexFile(metaFile, indexFile):
+    # scans indexFile (in binary, so that offsets are exact whatever the
+    # line endings), writes its meta-index to metaFile,
+    # and returns the list of keys in order
+    keys = []
+    lineOffsets = array('Q')
+    offset = 0
+    reader = open(indexFile, 'rb')
+    for inl in reader:
+        keys.append(inl[:inl.index(b':')].decode('utf-8'))
+        lineOffsets.append(offset)
+        offset += len(inl)
+    reader.close()
+    writeMetaIndex(metaFile, indexFile, keys, lineOffsets)
+    return keys
+
+
+def writeMetaIndex(metaFile, indexFile, keys, lineOffsets):
+    # writes the meta-index for indexFile, given its keys in order
+    # and the byte offset of each line
+    blob = bytearray()
+    keyStart = array('Q', [0])
+    for key in keys:
+        blob += key.encode('utf-8')
+        keyStart.append(len(blob))
+    padding = -len(blob) % 8  # :align the offset arrays
+    keysOffset = Header.size
+    keyStartOffset = keysOffset + len(blob) + padding
+    lineOffsetOffset = keyStartOffset + 8 * len(keyStart)
+    size, mtime = indexStamp(indexFile)
+    tempFile = tempFileFor(metaFile)
+    writer = open(tempFile, 'wb')
+    writer.write(Header.pack(Magic, size, mtime, len(keys), keysOffset,
+                             keyStartOffset, lineOffsetOffset))
+    writer.write(blob)
+    writer.write(bytes(padding))
+    writer.write(keyStart.tobytes())
+    writer.write(lineOffsets.tobytes())
+    writer.close()
+    os.replace(tempFile, metaFile)
+
+
+def isFresh(metaFile, indexFile):
+    # :does metaFile exist and describe the current version of indexFile?
+    return hasStamp(metaFile, indexFile, Header, Magic)
+
+
+# The loaded meta-index behaves like the MetaIndex dictionary
+# (MetaIndex[k] gives the line number of key k in the index file):
+
+class MappedMetaIndex:
+    def __init__(self, metaFile, indexFile):
+        self.indexFile = indexFile
+        self.reader = open(metaFile, 'rb')
+        self.mm = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.indexSize, mtime, self.numKeys, self.keysOffset,
+         keyStartOffset, lineOffsetOffset) = Header.unpack_from(self.mm, 0)
+        if magic != Magic:
+            raise Exception('Not a meta-index file: ' + metaFile)
+        self.view = memoryview(self.mm)
+        n = 8 * self.numKeys
+        self.keyStart = self.view[keyStartOffset:
+                                  keyStartOffset + n + 8].cast('Q')
+        self.lineOffset = self.view[lineOffsetOffset:
+                                    lineOffsetOffset + n].cast('Q')
+        self.indexReader = open(indexFile, 'rb')
+        # :opened here rather than on first use, which threads could race
+
+    def key(self, i):
+        return self.mm[self.keysOffset + self.keyStart[i]:
+                       self.keysOffset + self.keyStart[i + 1]].decode('utf-8')
+
+    def find(self, key):
+        # :binary search for key, returning its number or None
+        b = key.encode('utf-8')
+        lo, hi = 0, self.numKeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self.mm[self.keysOffset + self.keyStart[mid]:
+                        self.keysOffset + self.keyStart[mid + 1]]
+            if k < b:
+                lo = mid + 1
+            elif k > b:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return i + 1
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.numKeys
+
+    def __iter__(self):
+        for i in range(self.numKeys):
+            yield self.key(i)
+
+    def keys(self):
+        return list(self)
+
+    def lineAt(self, lineNo):
+        # :line lineNo of the index file (see readIndexLine)
+        start = self.lineOffset[lineNo - 1]
+        if lineNo < self.numKeys:
+            end = self.lineOffset[lineNo]
+        else:
+            end = self.indexSize
+        return readIndexLine(self.indexReader, start, end)
+
+    def close(self):
+        self.keyStart.release()
+        self.lineOffset.release()
+        self.view.release()
+        self.mm.close()
+        self.reader.close()
+        self.indexReader.close()
+
+
+# End of file
@@ -10,7 +10,6 @@
 
 # Start with very crude 'mod' hashing.
 # First, let's read a lowercase word as a base 27 integer:
-from index_build import *
 
 
 def toInt(w):
@@ -77,6 +76,10 @@ def miniHash(m, j):
     return (lambda w: modHash(w, d) % m)
 
 
+from pipeline_stats import Stats
+# :counts the j values tried (hashProbes), if enabled
+
+
 # TODO:
 # Add your code here.
 def addIndex(l):
@@ -124,12 +127,128 @@ def hashCompress(L, m):
         # set all occupied positions to be true
         for p in range(len(A)):
             T[A[p]] = True
+    if Stats.enabled:
+        # :j = 0, ..., R[i] tried for each non-empty bucket
+        Stats.add('hashProbes', sum(R) + sum(1 for b in L if len(b) > 1))
+    return R
+
+
+# Faster construction, giving the same choices as hashCompress (the least
+# suitable j for each bucket, taking buckets in the same order), but:
+#  - each key's integer is computed once, rather than on every probe;
+#  - occupied slots are kept in a bitset;
+#  - with NumPy, a whole batch of candidate j values is tried for a bucket
+#    at once, reducing each key's integer modulo all the moduli together.
+# Unlike hashCompress, the bucket lists are left unchanged.
+
+numpy = None
+NumpyTried = False
+# :NumPy is imported by loadNumpy when a Hasher is first built, not on
+# :import, so that query processes (which only hash) never pay for it
+
+
+def loadNumpy():
+    # :imports NumPy on first use and returns it (None if not installed)
+    global numpy, NumpyTried
+    if not NumpyTried:
+        try:
+            import numpy as imported
+        except ImportError:
+            imported = None
+        numpy = imported
+        NumpyTried = True
+    return numpy
+
+ProbeBatch = 64
+# :number of candidate j values tried together for a bucket (NumPy only)
+
+ScalarProbes = 32
+# :j values tried one at a time before switching to batches, since most
+# :buckets are placed within a few probes
+
+
+def hashCompressFast(L, m):
+    order = sorted(range(len(L)), key=lambda i: len(L[i]), reverse=True)
+    # :same order as the (stable) sort in hashCompress
+    R = [0] * len(L)
+    occupied = bytearray((m + 7) // 8)  # :bitset of slots already used
+    batched = loadNumpy() is not None
+    for b in order:
+        bucket = L[b]
+        if len(bucket) == 0:
+            continue
+        if batched:
+            found = findChoice(bucket, m, occupied, ScalarProbes)
+            if found is None:
+                found = findChoiceBatched(bucket, m, occupied, ScalarProbes)
+        else:
+            found = findChoice(bucket, m, occupied)
+        R[b], A = found
+        for a in A:
+            occupied[a >> 3] |= 1 << (a & 7)
+    if Stats.enabled:
+        Stats.add('hashProbes', sum(R) + sum(1 for b in L if b != []))
     return R
 
 
+def findChoice(bucket, m, occupied, limit=None):
+    # least j < limit placing bucket without clashes: returns (j, slots),
+    # or None if there is no such j
+    xs = [toInt(w) * 21436587 + 12345678912345 for w in bucket]
+    j = 0
+    while limit is None or j < limit:
+        d = j * 6 + 3000001
+        A = [x % d % m for x in xs]
+        if (len(set(A)) == len(A) and
+                not any(occupied[a >> 3] >> (a & 7) & 1 for a in A)):
+            return (j, A)
+        j += 1
+    return None
+
+
+def findChoiceBatched(bucket, m, occupied, j0):
+    # as findChoice, trying ProbeBatch values of j at a time from j0
+    global ProbeBatch
+    numpy = loadNumpy()
+    xs = [toInt(w) * 21436587 + 12345678912345 for w in bucket]
+    if min(xs) < 0:
+        return findChoice(bucket, m, occupied)
+        # :(never happens for keys made of letters)
+    bits = numpy.frombuffer(occupied, dtype=numpy.uint8)
+    # split each x into 24-bit limbs, most significant first, so that
+    # x mod d can be computed by Horner's rule within 64-bit integers:
+    width = max(1, (max(xs).bit_length() + 23) // 24)
+    X = numpy.array([[(x >> (24 * (width - 1 - i))) & 0xffffff
+                      for i in range(width)] for x in xs], dtype=numpy.int64)
+    while True:
+        d = numpy.arange(j0, j0 + ProbeBatch, dtype=numpy.int64) * 6 + 3000001
+        t = numpy.zeros((len(bucket), ProbeBatch), dtype=numpy.int64)
+        for i in range(width):
+            t = ((t << 24) + X[:, i:i + 1]) % d
+        A = t % m
+        # :A[k, c] is the slot for key k under j = j0 + c
+        free = ((bits[A >> 3] >> (A & 7)) & 1).sum(axis=0) == 0
+        S = numpy.sort(A, axis=0)
+        distinct = (S[1:] != S[:-1]).all(axis=0)
+        good = numpy.flatnonzero(free & distinct)
+        if len(good) > 0:
+            c = int(good[0])
+            return (j0 + c, A[:, c].tolist())
+        j0 += ProbeBatch
+
+
 # Putting it all together:
 # compact data structure for representing a perfect hash function
 
+import time
+
+HashCompressor = hashCompressFast
+# :construction used by Hasher (hashCompress gives the same results)
+
+ReportBuildTime = False
+# :if True, each Hasher prints its construction time
+
+
 class Hasher:
     def __init__(self, keys, lam, load):
         # keys : list of keys to be hashed
@@ -141,9 +260,14 @@ class Hasher:
         self.n = len(keys)
         self.r = prevPrime(int(self.n // lam))
         self.m = int(self.n // load)
+        time_start = time.time()
         HT = buildModHashTable(keys, self.r)
-        self.hashChoices = hashCompress(HT, self.m)
+        self.hashChoices = HashCompressor(HT, self.m)
         # :results in a very small data structure with no trace of keys!
+        self.buildTime = time.time() - time_start
+        if ReportBuildTime:
+            print('Hasher for ' + str(self.n) + ' keys built in ' +
+                  format(self.buildTime, '.3f') + 's')
 
     def hash(self, key):
         i = modHash(key, self.r)
@@ -165,6 +289,100 @@ def checkPerfectHasher(keys, H):
         return clashes
 
 
+# Sharded variant: keys are partitioned into independent shards, each with
+# its own Hasher, built in parallel worker processes. Shards are chosen by
+# crc32 rather than modHash: a shard's outer table is indexed by modHash
+# mod r, and if r were a multiple of the number of shards (e.g. r = 31 =
+# shards) all keys of the shard would fall in a single bucket, for which
+# no collision-free choice may exist.
+# Slots of shard i occupy the range offsets[i] .. offsets[i+1]-1 of the
+# combined table. When the key set changes, only shards whose keys have
+# changed are rebuilt; a fingerprint of each shard's keys is kept for
+# this purpose, rather than the keys themselves.
+
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def shardFingerprint(keys):
+    digest = hashlib.sha1()
+    for key in sorted(keys):
+        digest.update(key.encode() + b'\n')
+    return digest.digest()
+
+
+def buildShard(keys, lam, load):
+    if len(keys) == 0:
+        return None
+    return Hasher(keys, min(lam, len(keys)), load)
+    # :lam reduced for tiny shards, so the outer table has a bucket
+
+
+class ShardedHasher:
+    def __init__(self, keys, lam, load, shards=31, workers=1):
+        # shards : number of shards (best taken prime)
+        # workers : number of processes used to build shards
+        self.lam, self.load = lam, load
+        self.shards = shards
+        self.workers = workers
+        self.hashers = [None] * shards
+        self.fingerprints = [None] * shards
+        self.update(keys)
+
+    def shardOf(self, key):
+        # :independent of modHash, which the shards' own Hashers use
+        return zlib.crc32(key.encode()) % self.shards
+
+    def partition(self, keys):
+        parts = [[] for i in range(self.shards)]
+        for key in keys:
+            parts[self.shardOf(key)].append(key)
+        return parts
+
+    def update(self, keys):
+        # rebuilds the shards whose keys differ from those last used;
+        # returns the number of shards rebuilt
+        parts = self.partition(keys)
+        prints = [shardFingerprint(part) for part in parts]
+        changed = [i for i in range(self.shards)
+                   if prints[i] != self.fingerprints[i]]
+        if self.workers > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                built = list(pool.map(buildShard, [parts[i] for i in changed],
+                                      [self.lam] * len(changed),
+                                      [self.load] * len(changed)))
+        else:
+            built = [buildShard(parts[i], self.lam, self.load)
+                     for i in changed]
+        for k in range(len(changed)):
+            self.hashers[changed[k]] = built[k]
+            self.fingerprints[changed[k]] = prints[changed[k]]
+        self.offsets = [0]
+        for H in self.hashers:
+            self.offsets.append(self.offsets[-1] + (H.m if H else 0))
+        self.n = len(keys)
+        self.m = self.offsets[-1]
+        return len(changed)
+
+    def hash(self, key):
+        i = self.shardOf(key)
+        return self.offsets[i] + self.hashers[i].hash(key)
+
+
+def checkShardedHasher(keys, lam=5.0, load=0.8, shards=31):
+    # builds a ShardedHasher for keys, checking that no shard has all its
+    # keys in one outer bucket and that the combined hash is perfect;
+    # returns True if so
+    S = ShardedHasher(keys, lam, load, shards)
+    for (part, H) in zip(S.partition(keys), S.hashers):
+        if H is not None and H.r > 1 and len({modHash(k, H.r)
+                                              for k in part}) == 1:
+            print('Shard of ' + str(len(part)) + ' keys in one bucket.')
+            return False
+    return checkPerfectHasher(keys, S) is None
+
+
 # FOR INTEREST ONLY:
 
 # Calculating 'essential size' of a Hasher, given a crude compression scheme
@@ -194,13 +412,125 @@ def bestCompression(H):
             'bitsPerKey': best[1] / H.n}
 
 
+# Compressed representation of a Hasher, following bestCompression:
+# each choice j below the cutoff 2**bitWidth - 1 is stored in bitWidth bits
+# of a packed byte array; the others are stored as the cutoff itself,
+# with the real value kept in a small sorted table of outliers.
+
+from array import array
+import bisect
+
+
+class CompressedHasher:
+    def __init__(self, H, bitWidth=None):
+        self.n, self.r, self.m = H.n, H.r, H.m
+        if bitWidth is None:
+            if max(H.hashChoices) >= 16:
+                bitWidth = bestCompression(H)['bestBitWidth']
+            else:
+                bitWidth = max(H.hashChoices).bit_length() + 1
+                # :too few choices for bestCompression: no outliers needed
+        self.bitWidth = bitWidth
+        self.cutoff = 2 ** bitWidth - 1
+        self.bits = bytearray((self.r * bitWidth + 7) // 8 + 8)
+        self.outlierKeys = array('I')    # :sorted outer hash values
+        self.outlierChoices = array('I')
+        for i in range(self.r):
+            j = H.hashChoices[i]
+            if j >= self.cutoff:
+                self.outlierKeys.append(i)
+                self.outlierChoices.append(j)
+                j = self.cutoff
+            p = i * bitWidth
+            word = int.from_bytes(self.bits[p >> 3:(p >> 3) + 8], 'little')
+            word |= j << (p & 7)
+            self.bits[p >> 3:(p >> 3) + 8] = word.to_bytes(8, 'little')
+
+    def choice(self, i):
+        p = i * self.bitWidth
+        word = int.from_bytes(self.bits[p >> 3:(p >> 3) + 8], 'little')
+        j = (word >> (p & 7)) & self.cutoff
+        if j == self.cutoff:
+            k = bisect.bisect_left(self.outlierKeys, i)
+            j = self.outlierChoices[k]
+        return j
+
+    def hash(self, key):
+        i = modHash(key, self.r)
+        h = miniHash(self.m, self.choice(i))
+        return h(key)
+
+    def sizeInBytes(self):
+        return (len(self.bits) + self.outlierKeys.itemsize *
+                (len(self.outlierKeys) + len(self.outlierChoices)))
+
+
+# Using a perfect hash function as the meta-index:
+# a table of index line numbers indexed by hash slot (0 for empty slots).
+# Since no trace of the keys is kept, an absent key may be sent to the
+# line of some other key; indexEntryFor detects this by checking the key
+# found on that line (see index_build.MetaIndexExact).
+
+# With a TermDictionary (see term_dictionary.py) in place of the dictionary,
+# the table holds term IDs plus one, and an absent key is detected by
+# comparing it with the term having that ID, without reading the index.
+
+import index_build
+from term_dictionary import TermDictionary
+
+
+class PerfectMetaIndex:
+    def __init__(self, metaIndex, lam=5.0, load=0.8):
+        # metaIndex : dictionary from keys to index line numbers,
+        #             or a TermDictionary
+        keys = list(metaIndex.keys())
+        self.hasher = CompressedHasher(Hasher(keys, lam, load))
+        self.lines = array('I', bytes(4 * self.hasher.m))
+        if isinstance(metaIndex, TermDictionary):
+            self.terms = metaIndex
+            for i in range(len(keys)):
+                self.lines[self.hasher.hash(keys[i])] = i + 1
+        else:
+            self.terms = None
+            for key in keys:
+                self.lines[self.hasher.hash(key)] = metaIndex[key]
+
+    def lineNumber(self, key):
+        line = self.lines[self.hasher.hash(key)]
+        if line == 0 or (self.terms is not None and
+                         self.terms.term(line - 1) != key):
+            raise KeyError(key)
+        return line
+
+    def termId(self, key):
+        # :dense ID of key (its index line number less one)
+        return self.lineNumber(key) - 1
+
+    def sizeInBytes(self):
+        return self.hasher.sizeInBytes() + len(self.lines) * self.lines.itemsize
+
+
+def installPerfectMetaIndex(lam=5.0, load=0.8):
+    # replaces the dictionary lookup in index_build.MetaIndexOp
+    # by a PerfectMetaIndex for the current keys
+    index_build.ensureMetaIndex()
+    P = PerfectMetaIndex(index_build.MetaIndex, lam, load)
+    index_build.MetaIndexOp = P.lineNumber
+    index_build.MetaIndexExact = P.terms is not None
+    return P
+
+
 # End of file
 if __name__ == '__main__' :
     import time
-    buildIndex()
+    index_build.buildIndex()
     time_start=time.time()
-    H = Hasher(MetaIndex.keys(), 5.0, 0.8)
-    checkPerfectHasher(MetaIndex.keys(), H)
+    H = Hasher(index_build.MetaIndex.keys(), 5.0, 0.8)
+    checkPerfectHasher(index_build.MetaIndex.keys(), H)
+    keys = sorted(index_build.MetaIndex.keys())
+    for n in [4000, 5270, 6500]:
+        # :sizes at which shards of 31 once had outer tables of size 31
+        assert checkShardedHasher(keys[:n]), n
     time_end=time.time()
     print('totally cost',time_end-time_start)
 
@@ -0,0 +1,106 @@
+# Python source file: pipeline_stats.py
+
+# Opt-in counters and timers for the build and query pipeline.
+# Stats (below) is shared by all modules. While Stats.enabled is False,
+# as it is by default, nothing is counted: counts made once per buffer,
+# run or pass call Stats.add, which returns at once, and per-item counts
+# (heap operations in hit streams) are made by wrappers installed only
+# when enabled. Stage timers are started and stopped by the MemoryBudget
+# stages of buildIndex (or directly by start and stop); if Stats.profile
+# is also set, each stage is run under cProfile.
+
+# Counters:
+#    linesRead      : lines read through buffered_io readers
+#    bytesWritten   : text written through buffered_io writers
+#                     (characters for BufferedOutput, bytes for BytesOutput)
+#    entriesEmitted : index entries generated by buildIndex
+#    runs           : sorted runs created by buildIndex
+#    merges         : k-way merges of runs (mergeRuns)
+#    mergePasses    : passes over the data merging runs
+#    heapPushes, heapPops : heap operations in HitStreamQ and subclasses
+#    hashProbes     : choices of j tried by hashCompress(Fast)
+
+# Usage:
+#    from pipeline_stats import Stats
+#    Stats.enabled = True
+#    Stats.profile = True   # :optional
+#    index_build.buildIndex()
+#    Stats.report()
+
+import time
+# :cProfile and pstats are imported only when profiling, as this module
+# :is imported by every process, queries included
+
+
+class PipelineStats:
+    def __init__(self, enabled=False, profile=False):
+        self.enabled = enabled
+        self.profile = profile
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.times = {}     # :stage -> seconds (summed over runs of it)
+        self.profiles = {}  # :stage -> pstats.Stats
+        self.current = None
+        self.profiler = None
+
+    def add(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def counted(self, name, f):
+        # :f, counting its calls under name
+        def countedCall(*args):
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return f(*args)
+        return countedCall
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        if self.current is not None:
+            self.stop()
+        self.current = (name, time.perf_counter())
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if self.current is None:
+            return
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            name = self.current[0]
+            if name in self.profiles:
+                self.profiles[name].add(self.profiler)
+            else:
+                self.profiles[name] = pstats.Stats(self.profiler)
+            self.profiler = None
+        name, time_start = self.current
+        self.times[name] = (self.times.get(name, 0) +
+                            time.perf_counter() - time_start)
+        self.current = None
+
+    def dumpProfile(self, name, filename):
+        # :writes the profile of stage name, for pstats or snakeviz
+        self.profiles[name].dump_stats(filename)
+
+    def report(self, top=10):
+        # prints the counters and stage times, and for each profiled stage
+        # the top functions by cumulative time
+        for name in self.counts:
+            print(name.ljust(16) + str(self.counts[name]).rjust(12))
+        for name in self.times:
+            print(name.ljust(16) + format(self.times[name], '11.3f') + 's')
+        for name in self.profiles:
+            print('\nProfile of stage ' + name + ':')
+            self.profiles[name].sort_stats('cumulative').print_stats(top)
+
+
+Stats = PipelineStats()
+
+
+# End of file
@@ -0,0 +1,179 @@
+# Python source file: query_server.py
+
+# A local query service over search_queries, using asyncio.
+# Each connection is a session with its own hit stream cursor, so that
+# many clients can search (and ask for more hits) at the same time;
+# all sessions share the meta-index and index loaded by search_queries.
+# Index reads and hit computation are blocking, so they are run in a
+# thread pool rather than in the event loop.
+
+# Protocol: one JSON object per line in each direction, e.g.
+#    {"op": "search", "keys": ["first", "second"], "lineWindow": 1,
+#     "numberOfHits": 5}
+#    -> {"hits": [["TWP", 1234], ...], "absent": [], "truncated": {},
+#        "done": false}
+#    {"op": "more", "numberOfHits": 5}
+#    -> {"hits": [...], "done": true}
+# "truncated" maps each pattern key matching more than
+# index_build.MaxExpansion words to the number of them used.
+# Errors, including malformed requests, are reported as {"error": message}.
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import index_build
+import search_queries
+
+Executor = ThreadPoolExecutor(4)
+# :threads for blocking index reads and hit computation
+
+
+def checkCounts(**options):
+    # :raises ValueError unless each of options is a positive integer
+    for (name, value) in options.items():
+        if type(value) is not int or value < 1:
+            raise ValueError(name + ' must be a positive integer')
+
+
+class Session:
+    def __init__(self):
+        self.hitStream = None
+
+    def search(self, keys, lineWindow=1, numberOfHits=5, ranked=False,
+               minRequired=2):
+        if not (isinstance(keys, list) and
+                all(isinstance(k, str) for k in keys)):
+            raise ValueError('keys must be a list of strings')
+        checkCounts(lineWindow=lineWindow, numberOfHits=numberOfHits,
+                    minRequired=minRequired)
+        truncated = {}
+        itemStreams = search_queries.itemStreamsFor(keys, truncated)
+        absent = [keys[i] for i in range(len(keys)) if itemStreams[i] is None]
+        itemStreams = [s for s in itemStreams if s is not None]
+        if len(itemStreams) >= minRequired:
+            self.hitStream = search_queries.makeHitStream(
+                itemStreams, lineWindow, numberOfHits, ranked, minRequired)
+        else:
+            self.hitStream = None
+        result = self.more(numberOfHits)
+        result['absent'] = absent
+        result['truncated'] = truncated
+        return result
+
+    def more(self, numberOfHits=5):
+        checkCounts(numberOfHits=numberOfHits)
+        hits = []
+        while self.hitStream is not None and len(hits) < numberOfHits:
+            hit = self.hitStream.next()
+            if hit is None:
+                self.hitStream = None  # :no more hits
+            else:
+                hits.append(list(hit))
+        return {'hits': hits, 'done': self.hitStream is None}
+
+
+async def handle(reader, writer):
+    loop = asyncio.get_running_loop()
+    session = Session()
+    line = await reader.readline()
+    while line:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            op = request.pop('op', None)
+            if op == 'search':
+                call = session.search
+            elif op == 'more':
+                call = session.more
+            else:
+                raise ValueError('Unknown op: ' + str(op))
+            response = await loop.run_in_executor(
+                Executor, lambda: call(**request))
+        except Exception as e:
+            response = {'error': str(e)}
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+    writer.close()
+
+
+async def serve(host='127.0.0.1', port=8765, path=None):
+    # :serves on a Unix socket if path is given, else on TCP host:port
+    # load the index before accepting connections, rather than on the
+    # first requests (which would otherwise all be kept waiting)
+    if search_queries.ShardedReader is None:
+        index_build.ensureMetaIndex()
+        if index_build.IndexFormat == 'binary':
+            index_build.binaryIndex()
+    if path is not None:
+        server = await asyncio.start_unix_server(handle, path)
+    else:
+        server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+# Load generator: several clients sending search requests concurrently,
+# reporting latency percentiles.
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def loadClient(queries, requests, latencies, host, port, path):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    for i in range(requests):
+        request = {'op': 'search', 'keys': queries[i % len(queries)]}
+        time_start = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        await reader.readline()
+        latencies.append(time.perf_counter() - time_start)
+    writer.close()
+
+
+async def loadTest(queries, clients=8, requests=50,
+                   host='127.0.0.1', port=8765, path=None):
+    latencies = []
+    time_start = time.perf_counter()
+    await asyncio.gather(*[loadClient(queries, requests, latencies,
+                                      host, port, path)
+                           for i in range(clients)])
+    total = time.perf_counter() - time_start
+    print(str(len(latencies)) + ' requests in ' + format(total, '.2f') + 's')
+    print('p50 ' + format(percentile(latencies, 50) * 1000, '.2f') + 'ms, ' +
+          'p99 ' + format(percentile(latencies, 99) * 1000, '.2f') + 'ms')
+    return latencies
+
+
+# End of file
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['serve', 'load'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='Unix socket path')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--queries', default=None,
+                        help='file of queries, one per line')
+    args = parser.parse_args()
+    if args.mode == 'serve':
+        asyncio.run(serve(args.host, args.port, args.unix))
+    else:
+        if args.queries is not None:
+            with open(args.queries, encoding='utf-8') as f:
+                queries = [l.split() for l in f if l.strip() != '']
+        else:
+            ordinals = search_queries.ordinals
+            queries = [ordinals[i:i + 2] for i in range(len(ordinals) - 1)]
+        asyncio.run(loadTest(queries, args.clients, args.requests,
+                             args.host, args.port, args.unix))
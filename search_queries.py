@@ -6,8 +6,8 @@
 # (template file)
 
 import index_build
-
-index_build.generateMetaIndex('index.txt')
+# :the persisted meta-index is loaded on first use (see ensureMetaIndex),
+# :being regenerated only if stale
 
 
 # We find hits for queries using the index entries for the search terms.
@@ -32,6 +32,7 @@ class ItemStream:
         self.pos = 0
         self.doc = 0
         self.comma = 0
+        self.docEnd = None  # :where the next document starts (for skipToLast)
 
     def updateDoc(self):
         if self.entryString[self.pos].isalpha():
@@ -56,6 +57,67 @@ class ItemStream:
             self.pos = self.comma + 1
         return e
 
+    # For the skipping hit streams (HitStreamG, below), which search the
+    # entry string rather than decode it:
+
+    def size(self):
+        return len(self.entryString) - self.pos
+
+    def numberAt(self, pos, end):
+        # :the line number starting at pos, which ends by end
+        comma = self.entryString.find(',', pos, end)
+        return int(self.entryString[pos:comma if comma != -1 else end])
+
+    def nextDoc(self, pos):
+        # :where the first document code after pos starts (or the end)
+        m = DocCode.search(self.entryString, pos)
+        return m.start() if m is not None else len(self.entryString)
+
+    def skipToLast(self, bound, inclusive):
+        # moves on so that the next item is the last one before bound
+        # (or equal to it, if inclusive); stays put if the next item is not
+        e = self.peek()
+        if e is None or not beforeBound(e, bound, inclusive):
+            return
+        s = self.entryString
+        if self.docEnd is None or self.docEnd < self.pos:
+            self.docEnd = self.nextDoc(self.pos)
+        # :first the last document whose first item is before bound:
+        while self.docEnd < len(s) and bound[0] > self.doc and beforeBound(
+                (s[self.docEnd:self.docEnd + 3],
+                 self.numberAt(self.docEnd + 3, len(s))), bound, inclusive):
+            self.doc, self.pos = (s[self.docEnd:self.docEnd + 3],
+                                  self.docEnd + 3)
+            self.docEnd = self.nextDoc(self.pos)
+        # then search by position within its part of the entry, galloping
+        # and then binary: lo is the start of a line number before bound,
+        # and no number starting at hi or later is
+        lo, end, step = self.pos, self.docEnd, 8
+        while True:
+            start = s.find(',', min(lo + step, end) - 1, end - 1) + 1
+            # :of the first number starting step or more characters on
+            if start == 0:
+                hi = end
+                break
+            elif beforeBound((self.doc, self.numberAt(start, end)),
+                             bound, inclusive):
+                lo, step = start, step * 2
+            else:
+                hi = start
+                break
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            start = s.find(',', mid - 1, hi - 1) + 1
+            # :of the first number starting between mid and hi, if any
+            if start == 0:
+                hi = mid
+            elif beforeBound((self.doc, self.numberAt(start, end)),
+                             bound, inclusive):
+                lo = start
+            else:
+                hi = start
+        self.pos = lo
+
 
 # Comparing items (treating None as infinity):
 
@@ -120,18 +182,29 @@ class HitStream:
 
 import heapq
 
+from pipeline_stats import Stats
+
+
+def heapOps():
+    # :(heappush, heappop) for a hit stream, counting calls if Stats is enabled
+    if not Stats.enabled:
+        return (heapq.heappush, heapq.heappop)
+    return (Stats.counted('heapPushes', heapq.heappush),
+            Stats.counted('heapPops', heapq.heappop))
+
 
 # TODO:
 class HitStreamQ:
     #
     def __init__(self, itemStreams, lineWindow):
+        self.heappush, self.heappop = heapOps()
         self.itemStreams = itemStreams
         self.lineWindow = lineWindow
         # We use heap instead of list to help compare things,
         # firstly construct a heap using first items of each stream
         self.heap = []
         for i in range(len(itemStreams)):
-            heapq.heappush(self.heap, (self.itemStreams[i].pop(), i))
+            self.heappush(self.heap, (self.itemStreams[i].pop(), i))
         # begin by locating the earliest item in any stream:
         self.prev = self.nextItem()
         # store latest hit returned, so we can suppress duplicates:
@@ -143,7 +216,7 @@ class HitStreamQ:
             return (None, -1)
         # Else we just pop the smallest item out
         else:
-            s = heapq.heappop(self.heap)
+            s = self.heappop(self.heap)
         # Then check if the next to push in is None
         Next = self.itemStreams[s[1]].pop()
         # if yes, just leave that stream
@@ -151,7 +224,7 @@ class HitStreamQ:
             pass
         # else we push that element in the heap and heapify it
         else:
-            heapq.heappush(self.heap, (Next, s[1]))
+            self.heappush(self.heap, (Next, s[1]))
         return s
 
     def isHit(self, curr, prev):  # :do curr and prev together form a hit?
@@ -180,12 +253,436 @@ class HitStreamQ:
         # else return None
 
 
+# Hit streams with skipping (galloping version):
+# A hit is a pair of adjacent items, in the merged order, from different
+# streams. So in a run of consecutive items from the same stream, only
+# the first and last items can take part in a hit; the items in between
+# can be skipped without changing the hits found. Runs are long only in a
+# stream much larger than all the others together (by GallopRatio), and
+# HitStreamG jumps over the runs of such a stream by skipToLast (an
+# exponential then binary search, within the entry string itself for text
+# entries), so that the cost depends on the sizes of the rarer streams;
+# once only it is left, it is dropped, as its items can't form hits.
+# With two or more large streams, runs are short, and HitStreamG merges
+# the streams just as HitStreamQ does.
+
+import re
+import bisect
+
+DocCode = re.compile(r'[^\W\d_]{3}')
+# :document code in an index entry
+
+GallopRatio = 4
+# :HitStreamG skips through a stream at least this much larger than the
+# :others together (sizes as given by size())
+
+
+def beforeBound(item, bound, inclusive):
+    # :is item before bound (or equal to it, if inclusive)?
+    return item < bound or (inclusive and item == bound)
+
+
+def gallop(lines, start, line, inclusive):
+    # number of entries of lines[start:] before line (or equal to it,
+    # if inclusive), found by exponential then binary search
+    find = bisect.bisect_right if inclusive else bisect.bisect_left
+    lo, hi, step = start, start, 1
+    while hi < len(lines) and beforeBound(lines[hi], line, inclusive):
+        lo = hi
+        hi = lo + step
+        step *= 2
+    return find(lines, line, lo, min(hi, len(lines))) - start
+
+
+from array import array
+
+
+def decodeEntry(entryString):
+    # decodes an index entry into (docs, lines), where lines[i] is an array
+    # of the line numbers in document docs[i]
+    parts = re.split(r'([^\W\d_]{3})', entryString.rstrip('\n'))
+    # :e.g. ['', 'ABC', '01,23,', 'DEF', '004,056']
+    docs, lines = [], []
+    for i in range(1, len(parts), 2):
+        docs.append(parts[i])
+        lines.append(array('I', map(int, parts[i + 1].strip(',').split(','))))
+    return (docs, lines)
+
+
+class SkipItemStream:
+    # :item stream over decoded postings (which may be shared by streams)
+    def __init__(self, docs, lines):
+        self.docs, self.lines = docs, lines
+        self.g, self.k = 0, 0  # :position of next item
+        self.total = sum(len(l) for l in self.lines)
+
+    def size(self):
+        return self.total
+
+    def peek(self):
+        if self.g < len(self.docs):
+            return (self.docs[self.g], self.lines[self.g][self.k])
+
+    def pop(self):
+        e = self.peek()
+        if e is not None:
+            self.k += 1
+            if self.k == len(self.lines[self.g]):
+                self.g, self.k = self.g + 1, 0
+        return e
+
+    def skipToLast(self, bound, inclusive):
+        # moves on so that the next item is the last one before bound;
+        # stays put if the next item is not before bound
+        e = self.peek()
+        if e is None or not beforeBound(e, bound, inclusive):
+            return
+        g = self.g
+        while (g + 1 < len(self.docs) and beforeBound(
+                (self.docs[g + 1], self.lines[g + 1][0]), bound, inclusive)):
+            g += 1
+        start = self.k if g == self.g else 0
+        if self.docs[g] < bound[0]:
+            self.k = len(self.lines[g]) - 1
+        else:
+            self.k = start + gallop(self.lines[g], start, bound[1],
+                                    inclusive) - 1
+        self.g = g
+
+
+class HitStreamG(HitStreamQ):
+
+    def __init__(self, itemStreams, lineWindow):
+        global GallopRatio
+        sizes = [s.size() for s in itemStreams]
+        self.skip = [sizes[i] >= GallopRatio * (sum(sizes) - sizes[i])
+                     for i in range(len(sizes))]
+        # :the streams to skip through
+        if not any(self.skip):
+            self.nextItem = super().nextItem  # :merging as HitStreamQ does
+        HitStreamQ.__init__(self, itemStreams, lineWindow)
+
+    def nextItem(self):
+        if self.heap == []:
+            return (None, -1)
+        s = self.heappop(self.heap)
+        if self.heap == []:
+            return s  # :later items of this stream can't form hits
+        S = self.itemStreams[s[1]]
+        Next = S.pop()
+        if self.skip[s[1]] and Next is not None:
+            o, i = self.heap[0]
+            inclusive = s[1] < i  # :(Next, s[1]) comes before (o, i)?
+            if beforeBound(Next, o, inclusive):
+                # :Next is inside a run of S: go on to the run's last item
+                S.skipToLast(o, inclusive)
+                e = S.peek()
+                if e is not None and beforeBound(e, o, inclusive):
+                    Next = S.pop()
+        if Next is not None:
+            self.heappush(self.heap, (Next, s[1]))
+        return s
+
+
+# Hit streams requiring several terms:
+# A single pass over the merged items, keeping the items of the last
+# lineWindow lines (of the current document) together with a count of
+# items per term. As soon as at least minRequired distinct terms are
+# present, the start of the window is returned as a hit, and the window
+# is emptied so that hits don't overlap.
+
+from collections import deque
+
+
+class HitStreamM(HitStreamQ):
+
+    def __init__(self, itemStreams, lineWindow, minRequired=2):
+        self.itemStreams = itemStreams
+        self.lineWindow = lineWindow
+        self.minRequired = minRequired
+        self.heappush, self.heappop = heapOps()
+        self.heap = []
+        for i in range(len(itemStreams)):
+            if itemStreams[i].peek() is not None:
+                self.heappush(self.heap, (itemStreams[i].pop(), i))
+        self.window = deque()  # :(item, stream) for items in window
+        self.counts = {}       # :stream -> number of its items in window
+
+    def next(self):
+        item, i = self.nextItem()
+        while item is not None:
+            while self.window and (
+                    self.window[0][0][0] != item[0] or
+                    item[1] - self.window[0][0][1] >= self.lineWindow):
+                j = self.window.popleft()[1]
+                self.counts[j] -= 1
+                if self.counts[j] == 0:
+                    del self.counts[j]
+            self.window.append((item, i))
+            self.counts[i] = self.counts.get(i, 0) + 1
+            if len(self.counts) >= self.minRequired:
+                hit = self.window[0][0]
+                self.window.clear()
+                self.counts.clear()
+                return hit
+            item, i = self.nextItem()
+        # else return None
+
+
+# Ranked hits:
+# Here every item starts a candidate window of lineWindow lines, scored by
+# the number of distinct terms it contains and then by how closely they
+# are packed (smaller span first; earlier windows win ties). Of windows
+# ending at the same item, only the best is kept. The top k windows are
+# kept in a bounded heap, whose worst element is at the root.
+# Pruning (after MaxScore): a window only becomes a candidate with at
+# least d = 2 distinct terms (once the heap is full, with at least as many
+# as its worst window), so it must contain one of the n-d+1 terms with the
+# shortest posting lists (the 'essential' terms), as there are only d-1
+# others. Items of the other terms more than lineWindow lines from any
+# essential item are skipped (by skipToLast);
+# and once the current window and the streams still running hold too few
+# distinct terms for another candidate to get in, we stop.
+
+class RankedHits:
+    def __init__(self, itemStreams, lineWindow):
+        self.itemStreams = itemStreams
+        self.lineWindow = lineWindow
+        order = sorted(range(len(itemStreams)),
+                       key=lambda i: itemStreams[i].size())
+        self.rank = [0] * len(itemStreams)
+        for r in range(len(order)):
+            self.rank[order[r]] = r  # :number of terms with shorter postings
+        self.heap = []
+        for i in range(len(itemStreams)):
+            if itemStreams[i].peek() is not None:
+                heapq.heappush(self.heap, (itemStreams[i].pop(), i))
+
+    def reaches(self, first, item):
+        # :can a window starting at first contain item?
+        return (first is not None and item is not None and
+                first[0] == item[0] and item[1] - first[1] < self.lineWindow)
+
+    def nextEssential(self, essentials):
+        # :first item still to come of the essential terms, or None
+        upcoming = [x for (x, j) in self.heap if self.rank[j] < essentials]
+        return min(upcoming) if upcoming != [] else None
+
+    def skipBefore(self, S, e):
+        # returns the first item of stream S that a window containing
+        # item e could contain, skipping the items before it
+        if e is None:
+            return None  # :no later window can use this stream
+        start = (e[0], e[1] - self.lineWindow + 1)
+        S.skipToLast(start, False)
+        Next = S.pop()
+        while Next is not None and Next < start:
+            Next = S.pop()
+        return Next
+
+    def top(self, k):
+        # returns the best k windows as (startref, distinct terms, span),
+        # best first
+        top = []             # :heap of candidates (score, -seq, startref)
+        window = []          # :(item, stream, seq) for items in window
+        counts = {}          # :stream -> number of its items in window
+        pending = None       # :(candidate, seq of its last item)
+        seq = 0
+        lastEssential = None  # :last item in window of an essential term
+        e, eFor = None, None  # :nextEssential(eFor), unless an essential item
+        # :has been taken since
+        ended = set()         # :streams with no items left in self.heap
+        while True:
+            if self.heap != []:
+                item, i = heapq.heappop(self.heap)
+            else:
+                item = None
+            # close windows that can't reach the new item:
+            while window != [] and (item is None or
+                                    window[0][0][0] != item[0] or
+                                    item[1] - window[0][0][1] >= self.lineWindow):
+                first, j, start = window.pop(0)
+                if len(counts) >= 2:
+                    span = window[-1][0][1] - first[1] if window != [] else 0
+                    candidate = ((len(counts), -span), -start, first)
+                    end = window[-1][2] if window != [] else start
+                    if pending is not None and pending[1] == end:
+                        pending = max(pending, (candidate, end))
+                    else:
+                        if pending is not None:
+                            offerTop(top, k, pending[0])
+                        pending = (candidate, end)
+                counts[j] -= 1
+                if counts[j] == 0:
+                    del counts[j]
+            if item is None:
+                break
+            d = top[0][0][0] if len(top) == k else 2
+            # :distinct terms a window needs to get into top
+            essentials = len(self.itemStreams) - d + 1
+            S = self.itemStreams[i]
+            if self.rank[i] < essentials:
+                lastEssential, eFor = item, None
+                Next = S.pop()
+            else:
+                if eFor != essentials:
+                    e, eFor = self.nextEssential(essentials), essentials
+                if self.reaches(lastEssential, item) or self.reaches(item, e):
+                    Next = S.pop()
+                else:
+                    Next = self.skipBefore(S, e)
+                    item = None  # :in no window that could get into top
+            if Next is not None:
+                heapq.heappush(self.heap, (Next, i))
+            else:
+                ended.add(i)
+            if item is not None:
+                window.append((item, i, seq))
+                counts[i] = counts.get(i, 0) + 1
+                seq += 1
+            terms = len(self.heap) + len([j for j in counts if j in ended])
+            # :no window still to come can score better than this
+            if terms < 2 or (len(top) == k and top[0][0] >= (terms, 0)):
+                break
+        if pending is not None:
+            offerTop(top, k, pending[0])
+        top.sort(reverse=True)
+        return [(c[2], c[0][0], -c[0][1]) for c in top]
+
+
+class HitList:
+    # :presents a list of hits through the hit stream interface
+    def __init__(self, hits):
+        self.hits = hits
+        self.pos = 0
+
+    def next(self):
+        if self.pos < len(self.hits):
+            self.pos += 1
+            return self.hits[self.pos - 1]
+
+
+def offerTop(top, k, candidate):
+    # :keeps the best k candidates offered in heap top
+    if len(top) < k:
+        heapq.heappush(top, candidate)
+    elif candidate > top[0]:
+        heapq.heapreplace(top, candidate)
+
+
+# Prefix and wildcard queries: a key such as 'abando*' or 'wom?n' stands
+# for the index keys it matches (at most index_build.MaxExpansion of them,
+# to keep latency bounded), whose item streams are merged into a single
+# stream; several of them on the same line count as one item.
+
+class UnionItemStream:
+    def __init__(self, itemStreams):
+        self.itemStreams = list(itemStreams)
+        self.makeHeap()
+
+    def makeHeap(self):
+        self.heap = []
+        for i in range(len(self.itemStreams)):
+            e = self.itemStreams[i].peek()
+            if e is not None:
+                self.heap.append((e, i))
+        heapq.heapify(self.heap)
+
+    def size(self):
+        return sum(s.size() for s in self.itemStreams)
+
+    def peek(self):
+        if self.heap != []:
+            return self.heap[0][0]
+
+    def pop(self):
+        e = self.peek()
+        while self.heap != [] and self.heap[0][0] == e:
+            # :drop e from every stream it heads
+            i = self.heap[0][1]
+            self.itemStreams[i].pop()
+            Next = self.itemStreams[i].peek()
+            if Next is None:
+                heapq.heappop(self.heap)
+            else:
+                heapq.heapreplace(self.heap, (Next, i))
+        return e
+
+    def skipToLast(self, bound, inclusive):
+        # moves each stream to its last item before bound, then moves on
+        # all but those holding the latest such item
+        e = self.peek()
+        if e is None or not beforeBound(e, bound, inclusive):
+            return
+        last = e
+        for s in self.itemStreams:
+            s.skipToLast(bound, inclusive)
+            f = s.peek()
+            if f is not None and beforeBound(f, bound, inclusive) and last < f:
+                last = f
+        for s in self.itemStreams:
+            f = s.peek()
+            if f is not None and f < last:
+                s.pop()
+        self.makeHeap()
+
+
+def expandKeys(pattern):
+    # :as index_build.expandPattern (in the sharded index, if one is in use)
+    if ShardedReader is not None:
+        return ShardedReader.expandPattern(pattern, index_build.MaxExpansion)
+    return index_build.expandPattern(pattern, index_build.MaxExpansion)
+
+
+def patternKeys(pattern, truncated=None):
+    # keys matching pattern, reporting if there are too many: by printing,
+    # or by setting truncated[pattern] to the number of keys used if a
+    # dictionary truncated is given (as by query_server)
+    keys, cut = expandKeys(pattern)
+    if cut:
+        if truncated is not None:
+            truncated[pattern] = len(keys)
+        else:
+            print(pattern + ' matches more than ' + str(len(keys)) +
+                  ' words; using the first ' + str(len(keys)) + '\n')
+    return keys
+
+
+def unionStream(itemStreams):
+    # :merged item stream for itemStreams (of the keys of a pattern), or None
+    if itemStreams == []:
+        return None
+    if len(itemStreams) == 1:
+        return itemStreams[0]
+    return UnionItemStream(itemStreams)
+
+
+def patternStream(pattern, truncated=None):
+    # :merged item stream for the keys matching pattern, or None
+    return unionStream([itemStreamFor(k)
+                        for k in patternKeys(pattern, truncated)])
+
+
+def mergePostings(postingsList):
+    # :decoded postings (docs, lines) for the union of postingsList
+    byDoc = {}
+    for (docs, lines) in postingsList:
+        for i in range(len(docs)):
+            byDoc.setdefault(docs[i], []).append(lines[i])
+    docs = sorted(byDoc)
+    return (docs, [array('I', sorted(set().union(*byDoc[d]))) for d in docs])
+
+
 # Edit the following line to switch between implementations:
-HS = HitStreamQ  # :or HitStreamQ
+HS = HitStreamQ  # :or HitStream, HitStreamG
+
+# Displaying hits as corpus quotations
+# (lines are read through a SnippetCache, see corpus_lines.py):
 
-# Displaying hits as corpus quotations:
+from corpus_lines import SnippetCache
 
-import linecache
+Snippets = SnippetCache(100000)
+# :recently shown lines are kept within this many bytes
 
 
 def displayLines(startref, lineWindow):
@@ -193,10 +690,10 @@ def displayLines(startref, lineWindow):
         doc = startref[0]
         docfile = index_build.CorpusFiles[doc]
         line = startref[1]
-        print((doc + ' ' + str(line)).ljust(16) +
-              linecache.getline(docfile, line).strip())
+        lines = Snippets.lines(doc, docfile, line, lineWindow)
+        print((doc + ' ' + str(line)).ljust(16) + lines[0].strip())
         for i in range(1, lineWindow):
-            print(' ' * 16 + linecache.getline(docfile, line + i).strip())
+            print(' ' * 16 + lines[i].strip())
         print('')
 
 
@@ -207,10 +704,50 @@ def displayHits(hitStream, numberOfHits, lineWindow):
             print('-' * 16)
             break
         displayLines(startref, lineWindow)
-    linecache.clearcache()
     return hitStream
 
 
+# Querying a sharded index (see sharded_index.py): once useShardedIndex
+# has been called, index entries come from the shards owning the keys,
+# the keys of a query being looked up in all their shards at once.
+
+ShardedReader = None
+
+
+def useShardedIndex(manifestFile=None, threads=None):
+    # :queries use the sharded index described by manifestFile
+    global ShardedReader
+    import sharded_index
+    closeShardedIndex()
+    ShardedReader = sharded_index.ShardedIndex(manifestFile, threads)
+
+
+def closeShardedIndex():
+    # :queries use index_build's index again
+    global ShardedReader
+    if ShardedReader is not None:
+        ShardedReader.close()
+        ShardedReader = None
+
+
+def shardedItemStreams(keys, truncated=None):
+    # item streams for keys (None for absent keys), patterns being
+    # expanded first so that all entries are fetched together
+    expanded = [patternKeys(k, truncated) if index_build.isPattern(k)
+                else [k] for k in keys]
+    entries = iter(ShardedReader.entriesFor([k for ks in expanded
+                                             for k in ks]))
+    itemStreams = []
+    for i in range(len(keys)):
+        streams = [ItemStream(e) for e in
+                   [next(entries) for k in expanded[i]] if e is not None]
+        if index_build.isPattern(keys[i]):
+            itemStreams.append(unionStream(streams))
+        else:
+            itemStreams.append(streams[0] if streams != [] else None)
+    return itemStreams
+
+
 # Putting it together:
 
 currHitStream = None
@@ -218,24 +755,58 @@ currHitStream = None
 currLineWindow = 0
 
 
+def itemStreamFor(key, truncated=None):
+    # :item stream for key, or None if the key is absent from the index
+    # :(for truncated, see patternKeys)
+    if index_build.isPattern(key):
+        return patternStream(key, truncated)
+    if ShardedReader is not None:
+        entry = ShardedReader.entryFor(key)
+    elif index_build.IndexFormat == 'binary':
+        return index_build.binaryIndex().itemStream(key)
+    else:
+        entry = index_build.indexEntryFor(key)
+    return ItemStream(entry) if entry is not None else None
+
+
+def itemStreamsFor(keys, truncated=None):
+    if ShardedReader is not None:
+        return shardedItemStreams(keys, truncated)
+    return [itemStreamFor(k, truncated) for k in keys]
+
+
 def makeItemStreams(keys):
-    indexEntries = [index_build.indexEntryFor(k) for k in keys]
-    if not all(indexEntries):
+    keys = list(keys)
+    itemStreams = itemStreamsFor(keys)
+    if not all(itemStreams):
         message = "Words absent from index:  "
         for i in range(0, len(keys)):
-            if indexEntries[i] is None:
+            if itemStreams[i] is None:
                 message += (keys[i] + " ")
         print(message + '\n')
-    return [ItemStream(e) for e in indexEntries if e is not None]
+    return [s for s in itemStreams if s is not None]
+
 
+def makeHitStream(itemStreams, lineWindow=1, numberOfHits=5, ranked=False,
+                  minRequired=2):
+    # :hit stream for the given search options, as used by search
+    if ranked:
+        ranking = RankedHits(itemStreams, lineWindow).top(numberOfHits)
+        return HitList([r[0] for r in ranking if r[1] >= minRequired])
+    elif minRequired > 2:
+        return HitStreamM(itemStreams, lineWindow, minRequired)
+    else:
+        return HS(itemStreams, lineWindow)
 
-def search(keys, lineWindow=1, numberOfHits=5):
-    # :deleted minRequired as third parameter
+
+def search(keys, lineWindow=1, numberOfHits=5, ranked=False, minRequired=2):
+    # :minRequired, formerly the third parameter, now comes last
+    # :if ranked, shows the best numberOfHits windows (see RankedHits)
     itemStreams = makeItemStreams(keys)
-    if len(itemStreams) >= 2:  # :was minRequired
+    if len(itemStreams) >= minRequired:
         global currHitStream, currLineWindow
-        currHitStream = HS(itemStreams, lineWindow)
-        # :deleted minRequired
+        currHitStream = makeHitStream(itemStreams, lineWindow, numberOfHits,
+                                      ranked, minRequired)
         currLineWindow = lineWindow
         displayHits(currHitStream, numberOfHits, lineWindow)
 
@@ -245,6 +816,112 @@ def more(numberOfHits=5):
     displayHits(currHitStream, numberOfHits, currLineWindow)
 
 
+# Batch queries, with a cache of decoded posting lists:
+# each distinct term in a batch is fetched and decoded once, and decoded
+# postings are kept (least recently used first out) for later queries,
+# within a budget of memory. The cache is cleared whenever the index it
+# was filled from changes (see PostingCache.indexIdentity).
+
+import os
+from collections import OrderedDict
+from meta_index import indexStamp
+
+
+class PostingCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()  # :key -> ((docs, lines), size)
+        self.currSize = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.identity = None  # :of the index the entries come from
+
+    def indexIdentity(self):
+        # what the postings depend on: the index read (file, format, or
+        # sharded index), its version in this process, and its stamp
+        # (for an index rebuilt by another process)
+        global ShardedReader
+        indexFile = index_build.IndexFile
+        stamp = indexStamp(indexFile) if os.path.exists(indexFile) else None
+        return (indexFile, index_build.IndexFormat, ShardedReader,
+                index_build.IndexVersion, stamp)
+
+    def fetch(self, key):
+        # :decoded postings for key, or None if key is not in the index
+        if index_build.isPattern(key):
+            keys = expandKeys(key)[0]
+            if keys == []:
+                return None
+            return mergePostings([self.fetch(k) for k in keys])
+        if ShardedReader is not None:
+            entry = ShardedReader.entryFor(key)
+        elif index_build.IndexFormat == 'binary':
+            return index_build.binaryIndex().decodedPostings(key)
+        else:
+            entry = index_build.indexEntryFor(key)
+        return decodeEntry(entry) if entry is not None else None
+
+    def get(self, key):
+        identity = self.indexIdentity()
+        if identity != self.identity:
+            self.clear()
+            self.identity = identity
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        postings = self.fetch(key)
+        size = 64  # :rough overhead per entry (estimate)
+        if postings is not None:
+            size += sum(len(l) * l.itemsize + 64 for l in postings[1])
+        if size <= self.maxBytes:
+            self.entries[key] = (postings, size)
+            self.currSize += size
+            while self.currSize > self.maxBytes:
+                (k, (p, sz)) = self.entries.popitem(last=False)
+                self.currSize -= sz
+                self.evictions += 1
+        return postings
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.currSize}
+
+    def clear(self):
+        self.entries.clear()
+        self.currSize = 0
+
+
+Cache = PostingCache(index_build.MemoryAllowance)
+# :shared by all batch queries (budget may be changed via Cache.maxBytes)
+
+
+def batchHits(keyLists, lineWindow=1, numberOfHits=None, hitStream=HitStreamG):
+    # returns, for each list of keys, its first numberOfHits hits
+    # (or all of them, if numberOfHits is None)
+    global Cache
+    postings = {}
+    for keys in keyLists:
+        for k in keys:
+            if k not in postings:
+                postings[k] = Cache.get(k)
+    results = []
+    for keys in keyLists:
+        itemStreams = [SkipItemStream(*postings[k]) for k in keys
+                       if postings[k] is not None]
+        hits = []
+        if len(itemStreams) >= 2:
+            stream = hitStream(itemStreams, lineWindow)
+            curr = stream.next()
+            while curr is not None and (numberOfHits is None or
+                                        len(hits) < numberOfHits):
+                hits.append(curr)
+                curr = stream.next()
+        results.append(hits)
+    return results
+
+
 # For efficiency testing:
 
 def allHits(hitStream):
@@ -256,36 +933,134 @@ def allHits(hitStream):
     return hits
 
 
+# Checking the skipping searches (HitStreamG, and the pruning in
+# RankedHits) against plain merging, over random queries. Each query is
+# run both on the item streams of the index in use (text, binary or
+# sharded) and on decoded postings; prefix keys give union streams.
+
+import random
+
+CommonWords = ['that', 'which', 'with', 'have', 'from', 'prince', 'pierre']
+# :frequent words of the sample corpus, put in random queries so that
+# :some streams are large enough to be skipped through
+
+
+def randomKeyLists(n, seed=0):
+    # n random queries, each of one or two common words and one or two
+    # keys of the index (sometimes as a prefix pattern)
+    index_build.ensureMetaIndex()
+    keys = list(index_build.MetaIndex.keys())
+    rng = random.Random(seed)
+    keyLists = []
+    for q in range(n):
+        rare = rng.sample(keys, rng.randint(1, 2))
+        if rng.random() < 0.2 and len(rare[0]) >= 6:
+            rare[0] = rare[0][:5] + '*'
+        keyLists.append(rng.sample(CommonWords, rng.randint(1, 2)) + rare)
+    return keyLists
+
+
+def queryStreams(keys, decoded):
+    # :fresh item streams for those of keys in the index
+    if decoded:
+        postings = [Cache.get(k) for k in keys]
+        return [SkipItemStream(*p) for p in postings if p is not None]
+    return [s for s in itemStreamsFor(keys) if s is not None]
+
+
+def rankedWindows(itemStreams, lineWindow, k):
+    # the ranking RankedHits(itemStreams, lineWindow).top(k) should give,
+    # found by scoring the window starting at every item, with no pruning
+    items = []
+    for i in range(len(itemStreams)):
+        e = itemStreams[i].pop()
+        while e is not None:
+            items.append((e, i))
+            e = itemStreams[i].pop()
+    items.sort()
+    best = {}  # :last item of windows -> best candidate ending there
+    for s in range(len(items)):
+        first, t = items[s][0], s
+        while (t + 1 < len(items) and items[t + 1][0][0] == first[0] and
+               items[t + 1][0][1] - first[1] < lineWindow):
+            t += 1
+        terms = len({i for (e, i) in items[s:t + 1]})
+        if terms >= 2:
+            candidate = ((terms, first[1] - items[t][0][1]), -s, first)
+            best[t] = max(best.get(t, candidate), candidate)
+    top = sorted(best.values(), reverse=True)[:k]
+    return [(c[2], c[0][0], -c[0][1]) for c in top]
+
+
+def checkHitStreamG(keyLists, lineWindow=1):
+    # compares the hits of HitStreamG with those of HitStreamQ for each
+    # list of keys; returns the mismatches as (keys, decoded), if any
+    mismatches = []
+    for keys in keyLists:
+        for decoded in (False, True):
+            expected = allHits(HitStreamQ(queryStreams(keys, decoded),
+                                          lineWindow))
+            found = allHits(HitStreamG(queryStreams(keys, decoded),
+                                       lineWindow))
+            if found != expected:
+                mismatches.append((keys, decoded))
+    if len(mismatches) == 0:
+        print("No mismatches!")
+    else:
+        print("Mismatches found.")
+        return mismatches
+
+
+def checkRankedHits(keyLists, lineWindow=3, k=5):
+    # compares RankedHits.top(k) with rankedWindows for each list of
+    # keys; returns the mismatches as (keys, decoded), if any
+    mismatches = []
+    for keys in keyLists:
+        for decoded in (False, True):
+            expected = rankedWindows(queryStreams(keys, decoded),
+                                     lineWindow, k)
+            found = RankedHits(queryStreams(keys, decoded),
+                               lineWindow).top(k)
+            if found != expected:
+                mismatches.append((keys, decoded))
+    if len(mismatches) == 0:
+        print("No mismatches!")
+    else:
+        print("Mismatches found.")
+        return mismatches
+
+
 ordinals = ['first', 'second', 'third', 'fourth', 'fifth', 'sixth', 'seventh',
             'eighth', 'ninth', 'tenth', 'eleventh', 'twelfth', 'thirteenth',
             'fourteenth', 'fifteenth', 'sixteenth', 'seventeenth', 'eighteenth',
             'nineteenth', 'twentieth', 'thirtieth', 'fiftieth', 'hundredth',
             'thousandth', 'millionth']
 
-# Example:
-import time
-index_build.generateMetaIndex('index.txt')
-
-time_start=time.time()
-allHits(HitStream(makeItemStreams(ordinals),1))
-time_end=time.time()
-print('totally cost',time_end-time_start)
-
-time_start=time.time()
-allHits(HitStreamQ(makeItemStreams(ordinals),1))
-time_end=time.time()
-print('totally cost',time_end-time_start)
-
-time_start=time.time()
-search(index_build.MetaIndex.keys(), 3, 20)
-time_end=time.time()
-print('totally cost',time_end-time_start)
-
-time_start=time.time()
-for i in range(10):
-    allHits(HitStreamQ(makeItemStreams(ordinals), 1))
-    i += 1
-time_end=time.time()
-print('totally cost',(time_end-time_start)/10)
-print(allHits(HitStreamQ(makeItemStreams(ordinals), 1)))
 # End of file
+if __name__ == '__main__':
+    # Example:
+    import time
+
+    time_start=time.time()
+    allHits(HitStream(makeItemStreams(ordinals),1))
+    time_end=time.time()
+    print('totally cost',time_end-time_start)
+
+    time_start=time.time()
+    allHits(HitStreamQ(makeItemStreams(ordinals),1))
+    time_end=time.time()
+    print('totally cost',time_end-time_start)
+
+    time_start=time.time()
+    index_build.ensureMetaIndex()
+    search(index_build.MetaIndex.keys(), 3, 20)
+    time_end=time.time()
+    print('totally cost',time_end-time_start)
+
+    time_start=time.time()
+    for i in range(10):
+        allHits(HitStreamQ(makeItemStreams(ordinals), 1))
+        i += 1
+    time_end=time.time()
+    print('totally cost',(time_end-time_start)/10)
+    print(allHits(HitStreamQ(makeItemStreams(ordinals), 1)))
@@ -0,0 +1,285 @@
+# Python source file: sharded_index.py
+
+# A sharded index: the keys are partitioned into Shards parts, by key
+# range or by hash, and each part has its own index file and persisted
+# meta-index, so that no process need hold (or build) the whole index.
+# Each shard is built by buildIndex as usual, in a process of its own,
+# with index_build.KeyFilter keeping just the words of that shard: every
+# shard reads the whole corpus, but sorts, merges and indexes only its
+# own entries. Shards may therefore be built in parallel (here by a pool
+# of processes, each with the full MemoryAllowance), or on other machines.
+# Key ranges are chosen from a sample of the corpus, so that each shard
+# holds about the same number of entries; hashing needs no sample but
+# spreads the keys of a prefix pattern over all shards.
+# The layout (scheme, range boundaries, file names) is kept in a small
+# JSON manifest, read by ShardedIndex on the query side. A query looks
+# each term up in the shard owning it, the shards being read concurrently
+# by a pool of threads (see search_queries.useShardedIndex).
+
+# Usage:
+#    buildShardedIndex(4, 'range', workers=4)
+#    search_queries.useShardedIndex()
+#    search_queries.search(['first', 'second'])
+
+import os
+import json
+import zlib
+import heapq
+import shutil
+import tempfile
+import threading
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import index_build
+from meta_index import MappedMetaIndex, writeMetaIndexFile, isFresh
+
+Shards = 4
+# :default number of shards
+
+ShardScheme = 'range'
+# :'range' (keys split at boundaries sampled from the corpus) or 'hash'
+
+ManifestFile = 'index.shards'
+
+ShardIndexFile = 'index.{}.txt'
+ShardMetaFile = 'index.{}.meta'
+# :names of the index and meta-index files of shard i, formatted with i
+
+SampleLines = 20000
+# :lines read from the start of each corpus file to choose key ranges
+
+
+# Assigning keys to shards:
+
+def hashShard(key, shards):
+    # :stable across processes, unlike hash()
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def sampleBoundaries(corpusFiles, shards, sampleLines=None):
+    # returns shards-1 keys splitting the sampled entries into
+    # parts of about equal size: shard i holds the keys k with
+    # boundaries[i-1] <= k < boundaries[i]
+    global SampleLines
+    if sampleLines is None:
+        sampleLines = SampleLines
+    counts = Counter()
+    for filecode in corpusFiles:
+        for (inlineNo, words) in index_build.fileWords(corpusFiles[filecode]):
+            if inlineNo > sampleLines:
+                break
+            counts.update(words)
+    keys = sorted(counts)
+    total = sum(counts.values())
+    boundaries, seen = [], 0
+    for key in keys:
+        if seen >= total * (len(boundaries) + 1) / shards:
+            boundaries.append(key)
+            if len(boundaries) == shards - 1:
+                break
+        seen += counts[key]
+    return boundaries
+
+
+def shardOf(key, layout):
+    # :number of the shard holding key
+    if layout['scheme'] == 'hash':
+        return hashShard(key, layout['shards'])
+    return bisect_right(layout['boundaries'], key)
+
+
+class ShardFilter:
+    # :KeyFilter keeping the keys of one shard
+    def __init__(self, layout, shard):
+        self.layout, self.shard = layout, shard
+
+    def __call__(self, key):
+        return shardOf(key, self.layout) == self.shard
+
+
+# Building:
+
+def makeLayout(shards, scheme, corpusFiles):
+    global ShardIndexFile, ShardMetaFile
+    if scheme == 'range':
+        boundaries = sampleBoundaries(corpusFiles, shards)
+        shards = len(boundaries) + 1  # :fewer if the sample has few keys
+    elif scheme == 'hash':
+        boundaries = []
+    else:
+        raise ValueError('Unknown shard scheme: ' + str(scheme))
+    return {'scheme': scheme, 'shards': shards, 'boundaries': boundaries,
+            'indexFiles': [ShardIndexFile.format(i) for i in range(shards)],
+            'metaFiles': [ShardMetaFile.format(i) for i in range(shards)]}
+
+
+def buildShard(layout, shard, corpusFiles, settings=None):
+    # builds the index and meta-index of one shard, returning its number
+    # of keys; buildIndex uses fixed names for its temporary files,
+    # so each shard is built in a directory of its own; settings are
+    # the build settings of the parent process, if this is a worker
+    ib = index_build
+    if settings is not None:
+        ib.applyBuildSettings(settings)
+    saved = (ib.CorpusFiles, ib.IndexFile, ib.MetaIndexFile, ib.IndexFormat)
+    top = os.getcwd()
+    ib.CorpusFiles = {c: os.path.abspath(corpusFiles[c]) for c in corpusFiles}
+    ib.IndexFile = os.path.abspath(layout['indexFiles'][shard])
+    ib.MetaIndexFile = os.path.abspath(layout['metaFiles'][shard])
+    ib.IndexFormat = 'text'
+    ib.KeyFilter = ShardFilter(layout, shard)
+    directory = tempfile.mkdtemp(prefix='shard{}_'.format(shard), dir=top)
+    os.chdir(directory)
+    try:
+        ib.buildIndex()
+        keys = len(ib.MetaIndex)
+    finally:
+        os.chdir(top)
+        shutil.rmtree(directory)
+        ib.KeyFilter = None
+        (ib.CorpusFiles, ib.IndexFile, ib.MetaIndexFile,
+         ib.IndexFormat) = saved
+        ib.MetaIndexOp = ib.loadingMetaIndexOp
+        # :MetaIndex is that of the shard, so IndexFile's is loaded on use
+    return keys
+
+
+def buildShardedIndex(shards=None, scheme=None, workers=None,
+                      manifestFile=None):
+    # builds all shards of the index of index_build.CorpusFiles,
+    # using up to workers processes (1 means in this process),
+    # and writes the manifest; returns the layout
+    global Shards, ShardScheme, ManifestFile
+    if shards is None:
+        shards = Shards
+    if scheme is None:
+        scheme = ShardScheme
+    if workers is None:
+        workers = shards
+    if manifestFile is None:
+        manifestFile = ManifestFile
+    corpusFiles = index_build.CorpusFiles
+    layout = makeLayout(shards, scheme, corpusFiles)
+    if workers == 1:
+        keys = [buildShard(layout, i, corpusFiles)
+                for i in range(layout['shards'])]
+    else:
+        n = layout['shards']
+        with ProcessPoolExecutor(workers) as pool:
+            keys = list(pool.map(buildShard, [layout] * n, range(n),
+                                 [corpusFiles] * n,
+                                 [index_build.buildSettings()] * n))
+    layout['keys'] = keys
+    writer = open(manifestFile, 'w', encoding='utf-8')
+    json.dump(layout, writer, indent=1)
+    writer.close()
+    print('Built ' + str(layout['shards']) + ' shards: ' +
+          str(sum(keys)) + ' keys.')
+    return layout
+
+
+def loadLayout(manifestFile=None):
+    global ManifestFile
+    if manifestFile is None:
+        manifestFile = ManifestFile
+    reader = open(manifestFile, encoding='utf-8')
+    layout = json.load(reader)
+    reader.close()
+    # :file names are relative to the directory of the manifest
+    directory = os.path.dirname(manifestFile)
+    for files in ['indexFiles', 'metaFiles']:
+        layout[files] = [os.path.join(directory, f) for f in layout[files]]
+    return layout
+
+
+# Querying: each shard's persisted meta-index is mapped on first use,
+# and index entries are read from the shard files directly.
+
+class ShardedIndex:
+    def __init__(self, manifestFile=None, threads=None):
+        self.layout = loadLayout(manifestFile)
+        n = self.layout['shards']
+        self.metaIndexes = [None] * n
+        self.sortedKeys = [None] * n
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(threads if threads is not None else n)
+
+    def metaIndex(self, shard):
+        # :meta-index of shard, regenerated first if missing or stale
+        if self.metaIndexes[shard] is None:
+            with self.lock:  # :threads may ask for it at the same time
+                if self.metaIndexes[shard] is None:
+                    indexFile = self.layout['indexFiles'][shard]
+                    metaFile = self.layout['metaFiles'][shard]
+                    if not isFresh(metaFile, indexFile):
+                        writeMetaIndexFile(metaFile, indexFile)
+                    self.metaIndexes[shard] = MappedMetaIndex(metaFile,
+                                                              indexFile)
+        return self.metaIndexes[shard]
+
+    def shardOf(self, key):
+        return shardOf(key, self.layout)
+
+    def entryFor(self, key):
+        # :index entry for key (as index_build.indexEntryFor), or None
+        metaIndex = self.metaIndex(self.shardOf(key))
+        i = metaIndex.find(key)
+        if i is None:
+            return None
+        indexLine = metaIndex.lineAt(i + 1)
+        return indexLine[indexLine.index(':') + 1:]
+
+    def shardEntries(self, keys):
+        return [self.entryFor(k) for k in keys]
+
+    def entriesFor(self, keys):
+        # index entries for keys (None for absent keys), the keys of each
+        # shard being looked up by one task, all shards at the same time
+        byShard = {}
+        for i in range(len(keys)):
+            byShard.setdefault(self.shardOf(keys[i]), []).append(i)
+        futures = [(positions, self.pool.submit(
+                        self.shardEntries, [keys[i] for i in positions]))
+                   for positions in byShard.values()]
+        entries = [None] * len(keys)
+        for (positions, future) in futures:
+            for (i, entry) in zip(positions, future.result()):
+                entries[i] = entry
+        return entries
+
+    def expandPattern(self, pattern, limit=None):
+        # :as index_build.expandPattern, over the shards that may hold matches
+        shards = range(self.layout['shards'])
+        if self.layout['scheme'] == 'range':
+            prefix = pattern
+            for c in index_build.WildcardChars:
+                prefix = prefix.split(c)[0]
+            if prefix != '':
+                # :shards from that of prefix to that of the last key with it
+                shards = range(self.shardOf(prefix),
+                               self.shardOf(prefix + '\U0010ffff') + 1)
+        found, truncated = [], False
+        for s in shards:
+            if self.sortedKeys[s] is None:
+                self.sortedKeys[s] = index_build.SortedKeys(self.metaIndex(s))
+            keys, more = index_build.expandPattern(
+                pattern, limit, self.sortedKeys[s])
+            found.append(keys)
+            truncated = truncated or more
+        found = list(heapq.merge(*found))
+        if limit is not None and len(found) > limit:
+            return (found[:limit], True)
+        return (found, truncated)
+
+    def close(self):
+        self.pool.shutdown()
+        for metaIndex in self.metaIndexes:
+            if metaIndex is not None:
+                metaIndex.close()
+        self.metaIndexes = [None] * len(self.metaIndexes)
+        self.sortedKeys = [None] * len(self.sortedKeys)
+
+
+# End of file
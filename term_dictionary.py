@@ -0,0 +1,226 @@
+# Python source file: term_dictionary.py
+
+# A compact dictionary of the index keys (terms), giving each term a dense
+# integer ID: its position in sorted order, which is also its line number
+# in the index file less one (and its number in the binary index).
+# Terms are front-coded in blocks of BlockSize: the first term of a block
+# is stored in full, and each other term as the length of the prefix it
+# shares with the term before and the rest of its bytes. Only the first
+# term of each block is kept in memory, as a sparse index searched by
+# bisect; a lookup then decodes a single block of a few hundred bytes.
+# The byte offset of each index line is stored too (and left in the
+# mapped file), so that the line of a term is read by itself, as from a
+# persisted meta-index, rather than through linecache and a copy of the
+# whole index file in memory.
+
+# File layout:
+#    header     : magic, size and mtime of the index file, numTerms,
+#                 blockSize, numBlocks, and offsets of the sections below
+#    blocks     : front-coded terms, each as varints (shared, restLength)
+#                 followed by the rest (shared is 0 for the first of a block)
+#    blockStart : numBlocks+1 uint64 offsets of the blocks
+#    lineOffset : numTerms uint64 byte offsets of the index lines
+
+import os
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+
+from binary_index import encodeVarint, decodeVarint
+from meta_index import indexStamp, hasStamp, tempFileFor, readIndexLine
+
+Magic = b'IXTERM02'
+Header = struct.Struct('<8sQQQQQQQQ')
+# :magic, indexSize, indexMtime, numTerms, blockSize, numBlocks,
+# :blocksOffset, blockStartOffset, lineOffsetOffset
+
+BlockSize = 16
+# :terms per front-coded block
+
+
+def sharedPrefix(a, b):
+    # :length of the common prefix of byte strings a and b
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def indexKeys(indexFile, lineOffsets):
+    # :generator of the keys of indexFile, as bytes, appending the byte
+    # :offset of each line to lineOffsets
+    reader = open(indexFile, 'rb')
+    offset = 0
+    for inl in reader:
+        lineOffsets.append(offset)
+        offset += len(inl)
+        yield inl[:inl.index(b':')]
+    reader.close()
+
+
+def writeTermDictionary(dictFile, indexFile, keys=None, blockSize=None,
+                        lineOffsets=None):
+    # writes the term dictionary for indexFile, whose keys (in order)
+    # and line offsets are read from the file unless given
+    if blockSize is None:
+        blockSize = BlockSize
+    if keys is None or lineOffsets is None:
+        lineOffsets = array('Q')
+        keys = indexKeys(indexFile, lineOffsets)
+    tempFile = tempFileFor(dictFile)
+    writer = open(tempFile, 'wb')
+    writer.write(bytes(Header.size))  # :header filled in at the end
+    blockStart = array('Q')
+    buffer = bytearray()
+    pos = Header.size
+    prev = b''
+    numTerms = 0
+    for key in keys:
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if numTerms % blockSize == 0:
+            blockStart.append(pos + len(buffer))
+            shared = 0
+        else:
+            shared = sharedPrefix(prev, key)
+        encodeVarint(shared, buffer)
+        encodeVarint(len(key) - shared, buffer)
+        buffer += key[shared:]
+        prev = key
+        numTerms += 1
+        if len(buffer) > 65536:
+            writer.write(buffer)
+            pos += len(buffer)
+            buffer = bytearray()
+    blockStart.append(pos + len(buffer))
+    padding = -(pos + len(buffer)) % 8  # :align the offset array
+    buffer += bytes(padding)
+    blockStartOffset = pos + len(buffer)
+    writer.write(buffer)
+    writer.write(blockStart.tobytes())
+    lineOffsetOffset = blockStartOffset + 8 * len(blockStart)
+    writer.write(array('Q', lineOffsets).tobytes())
+    size, mtime = indexStamp(indexFile)
+    writer.seek(0)
+    writer.write(Header.pack(Magic, size, mtime, numTerms, blockSize,
+                             len(blockStart) - 1, Header.size,
+                             blockStartOffset, lineOffsetOffset))
+    writer.close()
+    os.replace(tempFile, dictFile)
+    return numTerms
+
+
+def isFresh(dictFile, indexFile):
+    # :does dictFile exist and describe the current version of indexFile?
+    return hasStamp(dictFile, indexFile, Header, Magic)
+
+
+# The loaded dictionary behaves like the MetaIndex dictionary
+# (TermDictionary[k] gives the line number of term k in the index file),
+# and also maps between terms and their IDs:
+
+class TermDictionary:
+    def __init__(self, dictFile, indexFile):
+        self.reader = open(dictFile, 'rb')
+        self.mm = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.indexSize, mtime, self.numTerms, self.blockSize,
+         numBlocks, blocksOffset, blockStartOffset,
+         lineOffsetOffset) = Header.unpack_from(self.mm, 0)
+        if magic != Magic:
+            raise Exception('Not a term dictionary file: ' + dictFile)
+        self.view = memoryview(self.mm)
+        n = 8 * self.numTerms
+        self.lineOffset = self.view[lineOffsetOffset:
+                                    lineOffsetOffset + n].cast('Q')
+        self.indexReader = open(indexFile, 'rb')
+        self.blockStart = array('Q')
+        self.blockStart.frombytes(
+            self.mm[blockStartOffset:blockStartOffset + 8 * (numBlocks + 1)])
+        self.firstTerms = []  # :sparse index: first term of each block
+        for b in range(numBlocks):
+            pos = self.blockStart[b]
+            shared, pos = decodeVarint(self.mm, pos)
+            length, pos = decodeVarint(self.mm, pos)
+            self.firstTerms.append(self.mm[pos:pos + length].decode('utf-8'))
+
+    def block(self, b):
+        # :list of the terms in block b
+        data = self.mm[self.blockStart[b]:self.blockStart[b + 1]]
+        terms = []
+        prev = b''
+        pos = 0
+        while pos < len(data):
+            shared, pos = decodeVarint(data, pos)
+            length, pos = decodeVarint(data, pos)
+            prev = prev[:shared] + data[pos:pos + length]
+            pos += length
+            terms.append(prev.decode('utf-8'))
+        return terms
+
+    def find(self, term):
+        # :ID of term, or None if absent
+        b = bisect_right(self.firstTerms, term) - 1
+        if b < 0:
+            return None
+        terms = self.block(b)
+        i = bisect_right(terms, term) - 1
+        if terms[i] != term:
+            return None
+        return b * self.blockSize + i
+
+    def term(self, i):
+        # :term with ID i
+        return self.block(i // self.blockSize)[i % self.blockSize]
+
+    def termsFrom(self, i):
+        # :generator of the terms with IDs i, i+1, ..., decoding each block once
+        b = i // self.blockSize
+        if b < len(self.firstTerms):
+            yield from self.block(b)[i % self.blockSize:]
+        for b in range(b + 1, len(self.firstTerms)):
+            yield from self.block(b)
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return i + 1
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.numTerms
+
+    def __iter__(self):
+        for b in range(len(self.firstTerms)):
+            yield from self.block(b)
+
+    def keys(self):
+        return list(self)
+
+    def lineAt(self, lineNo):
+        # :line lineNo of the index file (as MappedMetaIndex.lineAt)
+        start = self.lineOffset[lineNo - 1]
+        if lineNo < self.numTerms:
+            end = self.lineOffset[lineNo]
+        else:
+            end = self.indexSize
+        return readIndexLine(self.indexReader, start, end)
+
+    def sizeInBytes(self):
+        # :bytes of the mapped file plus the sparse index (estimate)
+        return (len(self.mm) + self.blockStart.itemsize * len(self.blockStart)
+                + sum(len(t) + 49 + 8 for t in self.firstTerms))
+
+    def close(self):
+        self.lineOffset.release()
+        self.view.release()
+        self.mm.close()
+        self.reader.close()
+        self.indexReader.close()
+
+
+# End of file